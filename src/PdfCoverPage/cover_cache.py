@@ -0,0 +1,295 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on windows, renders aren't coalesced across processes
+
+# seconds between attempts to take disk tier lock
+LOCK_POLL_INTERVAL = 0.01
+
+# bump when layout of cover-page changes so previously rendered PDFs aren't served
+COVER_VERSION = 1
+
+
+def cover_cache_key(identifier: str, fields: dict) -> str:
+    """
+    Content-addressed key for a rendered cover-page. The PDF only depends on the identifier and the fields from
+    extract_required_fields, so if neither change the previously rendered PDF can be reused
+    """
+    content = json.dumps({"version": COVER_VERSION, "identifier": identifier, "fields": fields}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class MemoryTier:
+    """In-process LRU of rendered PDFs, evicting least recently used once total size exceeds max_bytes"""
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            pdf = self._items.get(key)
+            if pdf is not None:
+                self._items.move_to_end(key)
+            return pdf
+
+    def put(self, key: str, pdf: bytes):
+        if len(pdf) > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self._size -= len(self._items.pop(key))
+            self._items[key] = pdf
+            self._size += len(pdf)
+
+            while self._size > self._max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class FileLocks:
+    """
+    Exclusive lock per key, shared by all processes on a host using the same directory, with a {key}.lock file per
+    key. The file is removed before the lock is released so none are left behind, including for renders that failed.
+    Anyone that was waiting then holds the lock on the removed file while anyone arriving later creates a new one, so
+    more than one process can hold the lock for a key at once. That's safe as holders check the cache once they have
+    the lock, the PDF is cached before the lock is released. It only means a key whose render failed may be rendered
+    more than once
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        if fcntl is None:
+            yield
+            return
+
+        path = os.path.join(self._directory, f"{key}.lock")
+        with open(path, "a") as lock_file:
+            # poll rather than block in flock, which would stall every greenlet when served with gevent
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # removed by a holder of the same key
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DiskTier:
+    """
+    Rendered PDFs stored in a directory, which can be shared by all processes on a host. Reads update mtime and
+    oldest files are removed once total size exceeds max_bytes
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str):
+        return os.path.join(self._directory, f"{key}.pdf")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                pdf = f.read()
+            os.utime(path)
+            return pdf
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, pdf: bytes):
+        # write to temp file + rename so other processes never see a partial PDF
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        files = []
+        total = 0
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".pdf"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(files):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another process
+            total -= size
+
+
+class S3Tier:
+    """
+    Rendered PDFs stored in an S3 (compatible) bucket, shared by all hosts. Eviction is left to the bucket's
+    lifecycle rules. The tier is optional so errors talking to S3 are logged and treated as a miss, or for put
+    ignored, rather than failing a request that can still be rendered
+    """
+
+    def __init__(self, get_client, bucket: str, prefix: str = ""):
+        self._get_client = get_client
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _key(self, key: str):
+        return f"{self._prefix}{key}.pdf"
+
+    def get(self, key: str):
+        try:
+            response = self._get_client().get_object(Bucket=self._bucket, Key=self._key(key))
+            return response["Body"].read()
+        except ClientError as e:
+            # without s3:ListBucket a missing key is AccessDenied rather than NoSuchKey
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                print(f"error getting '{self._key(key)}' from cover-page cache bucket: {e}")
+            return None
+        except BotoCoreError as e:
+            print(f"error getting '{self._key(key)}' from cover-page cache bucket: {e}")
+            return None
+
+    def put(self, key: str, pdf: bytes):
+        try:
+            self._get_client().put_object(Bucket=self._bucket, Key=self._key(key), Body=pdf,
+                                          ContentType="application/pdf")
+        except (BotoCoreError, ClientError) as e:
+            print(f"error putting '{self._key(key)}' in cover-page cache bucket: {e}")
+
+
+class CoverCache:
+    """
+    Tiered cache of rendered cover-pages, checked fastest first. A hit in a slower tier is copied into faster tiers
+    """
+
+    def __init__(self, tiers: list, locks: FileLocks = None):
+        """
+        :param tiers: tiers, fastest first
+        :param locks: optional FileLocks to coalesce renders across processes, only useful if there is a shared tier
+        """
+        self._tiers = tiers
+        self._locks = locks
+        # once a process has the lock for a key, it only needs to check the tiers up to the first one shared by all
+        # processes for a PDF rendered by another
+        shared_index = next((i for i, tier in enumerate(tiers) if not isinstance(tier, MemoryTier)), len(tiers) - 1)
+        self._locked_tiers = tiers[:shared_index + 1]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        pdf = self._find(key, self._tiers)
+        self._count(hit=pdf is not None)
+        return pdf
+
+    def get_or_render(self, key: str, render):
+        """
+        Get PDF from cache, or render + cache it if not found. If there are locks only one process on the host
+        renders a key at a time, others wait for it and then use its PDF
+        :param key: cache key
+        :param render: function returning PDF bytes
+        :return: tuple of (PDF bytes, True if rendered)
+        """
+        if (pdf := self._find(key, self._tiers)) is not None:
+            self._count(hit=True)
+            return pdf, False
+
+        with self._locks.lock(key) if self._locks else contextlib.nullcontext():
+            # may have been rendered by another process while waiting for lock
+            if self._locks and (pdf := self._find(key, self._locked_tiers)) is not None:
+                self._count(hit=True)
+                return pdf, False
+
+            pdf = render()
+            self.put(key, pdf)
+            self._count(hit=False)
+            return pdf, True
+
+    def put(self, key: str, pdf: bytes):
+        for tier in self._tiers:
+            tier.put(key, pdf)
+
+    def _find(self, key: str, tiers: list):
+        for i, tier in enumerate(tiers):
+            if (pdf := tier.get(key)) is not None:
+                for faster in tiers[:i]:
+                    faster.put(key, pdf)
+                return pdf
+        return None
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def cover_cache_from_env(get_s3_client) -> CoverCache:
+    """
+    Configure cache from env vars:
+      PDF_CACHE_MEMORY_BYTES - size of in-process LRU, 0 to disable (default 64MB)
+      PDF_CACHE_DIR - directory for disk tier, disabled if not set
+      PDF_CACHE_DIR_BYTES - size of disk tier (default 1GB)
+      PDF_CACHE_BUCKET - bucket for S3 tier, disabled if not set
+      PDF_CACHE_PREFIX - key prefix for S3 tier (default "pdf-cover/")
+      PDF_CACHE_LOCK_DIR - directory for lock files coalescing renders across processes on a host, when there's an
+        S3 tier but no disk tier (default {tempdir}/pdf-cover-locks). With a disk tier its directory is used
+    """
+    tiers = []
+    locks = None
+    if (memory_bytes := int(os.environ.get("PDF_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))) > 0:
+        tiers.append(MemoryTier(memory_bytes))
+
+    if cache_dir := os.environ.get("PDF_CACHE_DIR"):
+        tiers.append(DiskTier(cache_dir, int(os.environ.get("PDF_CACHE_DIR_BYTES", 1024 * 1024 * 1024))))
+        locks = FileLocks(cache_dir)
+
+    if cache_bucket := os.environ.get("PDF_CACHE_BUCKET"):
+        tiers.append(S3Tier(get_s3_client, cache_bucket, os.environ.get("PDF_CACHE_PREFIX", "pdf-cover/")))
+        if locks is None:
+            locks = FileLocks(os.environ.get("PDF_CACHE_LOCK_DIR",
+                                             os.path.join(tempfile.gettempdir(), "pdf-cover-locks")))
+
+    return CoverCache(tiers, locks)
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CachedFields:
+    __slots__ = ("fields", "etag", "expires")
+
+    def __init__(self, fields: dict, etag: str, expires: float):
+        self.fields = fields
+        self.etag = etag
+        self.expires = expires
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires
+
+
+class FieldsCache:
+    """
+    In-process LRU of the fields extracted from each manifest, keyed by identifier. Entries are used as-is for ttl
+    seconds, after that they should be revalidated with S3 using the stored ETag and refresh() called if unchanged
+    """
+
+    def __init__(self, max_items: int, ttl: float):
+        self._max_items = max_items
+        self._ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, identifier: str):
+        with self._lock:
+            cached = self._items.get(identifier)
+            if cached is not None:
+                self._items.move_to_end(identifier)
+            return cached
+
+    def put(self, identifier: str, fields: dict, etag: str):
+        if self._max_items <= 0:
+            return
+
+        with self._lock:
+            self._items[identifier] = CachedFields(fields, etag, time.monotonic() + self._ttl)
+            self._items.move_to_end(identifier)
+            while len(self._items) > self._max_items:
+                self._items.popitem(last=False)
+
+    def refresh(self, identifier: str):
+        """Manifest unchanged since cached, extend expiry"""
+        with self._lock:
+            if cached := self._items.get(identifier):
+                cached.expires = time.monotonic() + self._ttl
+
+    def count(self, outcome: str):
+        """Record outcome of lookup, one of 'hits', 'revalidated' or 'misses'"""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+
+def fields_cache_from_env() -> FieldsCache:
+    """
+    Configure cache from env vars:
+      FIELDS_CACHE_ITEMS - max number of manifests to hold fields for, 0 to disable (default 10000)
+      FIELDS_CACHE_TTL - seconds fields are used without revalidating against S3 (default 60)
+    """
+    return FieldsCache(int(os.environ.get("FIELDS_CACHE_ITEMS", 10000)),
+                       float(os.environ.get("FIELDS_CACHE_TTL", 60)))
@@ -1,11 +1,15 @@
-import json
 import io
 import os
+import threading
+import time
 import boto3
+import ijson
 
+from botocore.config import Config
+from contextlib import closing
 from botocore.exceptions import ClientError
 from http import HTTPStatus
-from flask import Flask, jsonify, send_file
+from flask import Flask, Response, jsonify, send_file
 
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
@@ -14,36 +18,181 @@ from reportlab.platypus.flowables import TopPadder
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import A4
 
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    monkey = None  # only needed when served with gevent
+
+from cover_cache import cover_cache_from_env, cover_cache_key
+from fields_cache import fields_cache_from_env
+from logo_cache import Logo, logo_cache_from_env
+from metrics import CountingReader, metrics_from_env
+from single_flight import SingleFlight
+
 app = Flask(__name__)
 
 region = os.environ.get("AWS_REGION", "eu-west-1")
 manifest_bucket = os.environ.get("MANIFEST_BUCKET", "wellcomecollection-stage-iiif-presentation")
 key_prefix = os.environ.get("KEY_PREFIX", "v3")
+cache_max_age = int(os.environ.get("CACHE_MAX_AGE", 3600))
+fonts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+logos_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logos")
+
+# top-level manifest keys used by extract_required_fields
+REQUIRED_KEYS = {"label", "homepage", "metadata", "requiredStatement", "provider"}
+
+s3_config = Config(
+    max_pool_connections=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 10)),
+    connect_timeout=int(os.environ.get("S3_CONNECT_TIMEOUT", 5)),
+    read_timeout=int(os.environ.get("S3_READ_TIMEOUT", 30)),
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+# native threads used for rendering under gevent, see run_cpu_bound()
+render_threads = int(os.environ.get("RENDER_THREADS", 2))
+_render_pool = None
+_render_pool_pid = None
+
+# s3 client for this process, see get_s3_client()
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+# fonts + styles, loaded once per process by get_static_resources()
+_static_resources = None
+_static_resources_lock = threading.Lock()
 
 
 @app.route('/pdf-cover/<string:identifier>', methods=["GET"])
 def generate_pdf(identifier: str):
     """Uses data from S3 manifest to construct PDF response"""
-    manifest = get_manifest(identifier)
+    request_record = metrics.start_request(identifier=identifier)
+    try:
+        cover_page = get_cover_page(identifier)
+    except Exception:
+        metrics.finish_request(request_record, HTTPStatus.INTERNAL_SERVER_ERROR.value)
+        raise
 
-    if not manifest:
+    if cover_page is None:
         print(f"could not find manifest for '{identifier}'")
+        metrics.finish_request(request_record, HTTPStatus.NOT_FOUND.value)
         return {
                    "statusDescription": f'{HTTPStatus.NOT_FOUND.value} - {HTTPStatus.NOT_FOUND.phrase}',
                    "body": "Manifest for identifier not found",
                }, 404
 
-    print(f"generating PDF cover-page for '{identifier}'")
+    cache_key, pdf, rendered = cover_page
+    metrics.observe("pdf_cover_pdf_bytes", len(pdf))
+
+    # key is content-addressed so doubles as ETag, conditional requests get a 304
+    # 'send' covers building the response, writing it to the client happens in uwsgi after this returns
+    with metrics.stage("send"):
+        response = send_file(io.BytesIO(pdf), mimetype="application/pdf", etag=cache_key, max_age=cache_max_age,
+                             conditional=True)
+    metrics.finish_request(request_record, response.status_code, rendered=rendered, pdf_bytes=len(pdf))
+    return response
 
+
+def get_cover_page(identifier: str):
+    """
+    Get PDF cover-page for identifier, rendering it if there isn't one cached for current manifest. Concurrent calls
+    for the same identifier are coalesced so only one fetches + renders, the others wait and share its result
+    :param identifier: manifest to get cover-page for
+    :return: tuple of (cache key, PDF bytes, True if rendered), or None if manifest not found
+    """
+    return cover_page_flights.do(identifier, load_cover_page, identifier)
+
+
+def load_cover_page(identifier: str):
+    """Get cover-page for identifier from cache, or render it. See get_cover_page()"""
     # take the pertinent fields and flatten them to make easier to use
-    relevant_fields = extract_required_fields(manifest)
+    relevant_fields = get_required_fields(identifier)
+
+    if relevant_fields is None:
+        return None
+
+    def render():
+        print(f"generating PDF cover-page for '{identifier}'")
+        # logo may need fetching, get it before handing off CPU-bound build
+        logo = logo_cache.get(relevant_fields["provider"][0]["logo"][0]["id"])
+        with metrics.stage("build_pdf"):
+            return run_cpu_bound(build_pdf, relevant_fields, identifier, logo).getvalue()
 
-    # generate PDF and get bytes
-    pdf_bytes = build_pdf(relevant_fields, identifier)
-    pdf_bytes.seek(0)
-    print(f"generated PDF cover-page for '{identifier}'")
+    # PDF only changes if the fields used change, reuse previous render if there is one
+    cache_key = cover_cache_key(identifier, relevant_fields)
+    pdf, rendered = cover_cache.get_or_render(cache_key, render)
+    if rendered:
+        print(f"generated PDF cover-page for '{identifier}'")
+    else:
+        print(f"using cached PDF cover-page for '{identifier}'")
+    return cache_key, pdf, rendered
 
-    return send_file(pdf_bytes, mimetype="application/pdf")
+
+def get_required_fields(identifier: str):
+    """
+    Get fields required for cover-page, from fields_cache if possible. Once cached fields are stale they are
+    revalidated with a conditional GET, so manifest is only downloaded + parsed again if it has changed
+    :param identifier: manifest to get fields for
+    :return: dict of fields, or None if manifest not found
+    """
+    cached = fields_cache.get(identifier)
+    if cached and cached.is_fresh():
+        fields_cache.count("hits")
+        return cached.fields
+
+    with metrics.stage("get_manifest"):
+        manifest, etag = get_manifest(identifier, cached.etag if cached else None)
+    if manifest is None:
+        fields_cache.count("revalidated")
+        fields_cache.refresh(identifier)
+        return cached.fields
+
+    fields_cache.count("misses")
+    if not manifest:
+        return None
+
+    with metrics.stage("extract_required_fields"):
+        relevant_fields = extract_required_fields(manifest)
+    fields_cache.put(identifier, relevant_fields, etag)
+    return relevant_fields
+
+
+def read_required_top_level(stream) -> dict:
+    """
+    Incrementally parse manifest from stream, only building values for top-level REQUIRED_KEYS. Everything else,
+    notably items + structures, is still tokenised, so its strings and numbers are decoded, but they are dropped
+    straight away rather than built into lists and dicts. basic_parse is used rather than parse so a prefix isn't
+    built for every event either. Reading stops once all REQUIRED_KEYS have been read, so if they precede items the
+    bulk of the manifest is never read
+    :param stream: file-like object, e.g. S3 StreamingBody
+    :return: dict containing REQUIRED_KEYS that are in manifest
+    """
+    manifest = {}
+    key = None
+    builder = None
+    depth = 0
+    for event, value in ijson.basic_parse(stream, use_float=True):
+        if depth == 1 and event in ("map_key", "end_map"):
+            # top-level map_key or end_map, so any value being built is complete
+            if builder is not None:
+                manifest[key] = builder.value
+                builder = None
+                if len(manifest) == len(REQUIRED_KEYS):
+                    break
+
+            if event == "map_key" and value in REQUIRED_KEYS:
+                key = value
+                builder = ijson.ObjectBuilder()
+        elif builder is not None:
+            builder.event(event, value)
+
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+
+    return manifest
 
 
 def extract_required_fields(manifest):
@@ -69,13 +218,14 @@ def extract_required_fields(manifest):
     return relevant_fields
 
 
-def build_pdf(data: dict, identifier: str):
-    """build pdf and return bytes"""
+def build_pdf(data: dict, identifier: str, logo=None):
+    """
+    build pdf and return bytes
+    :param logo: ImageReader for provider logo, from logo_cache. If None no logo is shown
+    """
 
     # configure document
-    register_fonts()
-    styles = configure_stylesheet()
-    normal = configure_normal_style()
+    styles, normal = get_static_resources()
 
     # build elements
     pdf_elements = []
@@ -130,12 +280,11 @@ def build_pdf(data: dict, identifier: str):
     provider_label = wellcome_provider["label"]
     address_parts = provider_label[get_first_lang(provider_label)]
 
-    logo_url = wellcome_provider["logo"][0]["id"]
-
     # create a table of 2 columns
     # the first has the image, the seconds has multiple rows - 1 per address part
     bottom = Table([(
-        Paragraph(f"<img src='{logo_url}' height='66' width='200'/>"),
+        # logo is fetched + decoded once and reused, if it can't be loaded leave a gap rather than failing
+        Logo(logo, width=200, height=66) if logo else "",
         [Paragraph(part, styles["Footer"]) for part in address_parts])])
     bottom.setStyle([
         ("BOTTOMPADDING", (0, 0), (0, 0), 10)
@@ -148,6 +297,22 @@ def build_pdf(data: dict, identifier: str):
     return pdf_bytes
 
 
+def get_static_resources():
+    """
+    Get (stylesheet, normal style), registering fonts on first call. Parsing the TTF files and building the
+    stylesheet is expensive so is done once per process and shared by all requests + threads
+    """
+    global _static_resources
+    if _static_resources is None:
+        with _static_resources_lock:
+            if _static_resources is None:
+                start = time.perf_counter()
+                register_fonts()
+                _static_resources = (configure_stylesheet(), configure_normal_style())
+                print(f"loaded fonts and styles in {(time.perf_counter() - start) * 1000:.0f}ms (pid {os.getpid()})")
+    return _static_resources
+
+
 def configure_normal_style():
     normal = ParagraphStyle("Normal")
     normal.fontSize = 12
@@ -164,8 +329,8 @@ def configure_stylesheet():
 
 
 def register_fonts():
-    pdfmetrics.registerFont(TTFont("Inter", "fonts/Inter-Regular.ttf"))
-    pdfmetrics.registerFont(TTFont("Inter-Bold", "fonts/Inter-Bold.ttf"))
+    pdfmetrics.registerFont(TTFont("Inter", os.path.join(fonts_dir, "Inter-Regular.ttf")))
+    pdfmetrics.registerFont(TTFont("Inter-Bold", os.path.join(fonts_dir, "Inter-Bold.ttf")))
 
 
 def get_first_lang_value(el):
@@ -177,24 +342,88 @@ def get_first_lang(el):
     return next(iter(el))
 
 
-def get_manifest(identifier: str) -> dict:
+def get_manifest(identifier: str, etag: str = None) -> tuple:
     """
-    Gets specified json-containing key as a dict
+    Gets top-level REQUIRED_KEYS of specified json-containing key as a dict
     :param identifier: manifest to get
-    :return: Key as dictionary
+    :param etag: optional ETag of previously fetched manifest, if it hasn't changed the body isn't downloaded
+    :return: tuple of (key as dictionary, ETag). Dictionary is None if unchanged from etag, or empty if not found
     """
     try:
-        client = boto3.client("s3", region)
-        response = client.get_object(Bucket=manifest_bucket, Key=f"{key_prefix}/{identifier}")
-        manifest = response.get("Body", "").read().decode()
-        return json.loads(manifest)
+        client = get_s3_client()
+        request = {"Bucket": manifest_bucket, "Key": f"{key_prefix}/{identifier}"}
+        if etag:
+            request["IfNoneMatch"] = etag
+        response = client.get_object(**request)
+        with closing(response["Body"]) as body:
+            counting_body = CountingReader(body)
+            manifest = read_required_top_level(counting_body)
+            metrics.observe("pdf_cover_manifest_bytes", counting_body.bytes_read)
+            return manifest, response.get("ETag")
     except ClientError as e:
         if e.response["Error"]["Code"] == "NoSuchKey":
-            return {}
+            return {}, None
+
+        if e.response["Error"]["Code"] == "304":
+            return None, etag
 
         raise
 
 
+def run_cpu_bound(fn, *args):
+    """
+    Run CPU-bound function, e.g. build_pdf. Under gevent (uwsgi --gevent) this is on a bounded pool of native threads
+    so that rendering doesn't block the event loop, and other requests carry on with S3 I/O meanwhile. Otherwise it
+    is run directly as each request already has its own worker thread
+    """
+    if monkey is None or not monkey.is_module_patched("socket"):
+        return fn(*args)
+
+    global _render_pool, _render_pool_pid
+    if _render_pool_pid != os.getpid():
+        # pool threads don't survive fork, create per process
+        _render_pool = ThreadPool(render_threads)
+        _render_pool_pid = os.getpid()
+    return _render_pool.apply(fn, args)
+
+
+def get_s3_client():
+    """
+    Get S3 client for this process. Creating a client is slow (endpoint resolution, credentials, new connections)
+    so one is created on first use and reused by all requests. Clients aren't fork-safe, uwsgi imports the app in
+    master then forks workers, so a new client is created if the pid has changed
+    """
+    global _s3_client, _s3_client_pid
+    if _s3_client_pid != os.getpid():
+        with _s3_client_lock:
+            if _s3_client_pid != os.getpid():
+                _s3_client = boto3.session.Session().client("s3", region, config=s3_config)
+                _s3_client_pid = os.getpid()
+    return _s3_client
+
+
+cover_cache = cover_cache_from_env(get_s3_client)
+fields_cache = fields_cache_from_env()
+cover_page_flights = SingleFlight()
+logo_cache = logo_cache_from_env(logos_dir)
+metrics = metrics_from_env()
+
+
+def cache_counters():
+    """Cache hit/miss counts for metrics"""
+    cache = "pdf_cover_cache_requests_total"
+    return [
+        (cache, {"cache": "cover", "result": "hit"}, cover_cache.hits),
+        (cache, {"cache": "cover", "result": "miss"}, cover_cache.misses),
+        (cache, {"cache": "fields", "result": "hit"}, fields_cache.hits),
+        (cache, {"cache": "fields", "result": "revalidated"}, fields_cache.revalidated),
+        (cache, {"cache": "fields", "result": "miss"}, fields_cache.misses),
+    ]
+
+
+metrics.add_collector(cache_counters)
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify({"Error": "Resource not found"}), 404
@@ -205,5 +434,14 @@ def ping():
     return jsonify(status='working')
 
 
+@app.route('/pdf-cover/metrics', methods=["GET"])
+def get_metrics():
+    """Request, stage timing, size and cache metrics in Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# load at import so the first request doesn't pay for it. Under uwsgi this happens once in master, before fork
+get_static_resources()
+
 if __name__ == '__main__':
     app.run(debug=True)
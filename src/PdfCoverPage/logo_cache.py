@@ -0,0 +1,120 @@
+import io
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from collections import OrderedDict
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Flowable
+
+from single_flight import SingleFlight
+
+
+class Logo(Flowable):
+    """Draws a shared, already decoded, ImageReader at a fixed size"""
+
+    def __init__(self, image: ImageReader, width: float, height: float):
+        super().__init__()
+        self._image = image
+        self.width = width
+        self.height = height
+
+    def wrap(self, available_width, available_height):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self._image, 0, 0, self.width, self.height, mask="auto")
+
+
+class LogoCache:
+    """
+    Decoded logo images by URL, LRU bounded by size of image files. Logos are fetched on first use, unless there is a
+    bundled file in seed_dir named as the last segment of the URL path. The host isn't compared as it varies by
+    environment, e.g. https://iiif-test.wellcomecollection.org/logos/wellcome-collection-black.png uses
+    {seed_dir}/wellcome-collection-black.png
+
+    Failed loads are remembered for failure_ttl seconds, until then get() returns None without trying again so an
+    unavailable logo host doesn't hold up every render
+    """
+
+    def __init__(self, seed_dir: str, max_bytes: int, timeout: float, failure_ttl: float):
+        self._seed_dir = seed_dir
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+        self._failure_ttl = failure_ttl
+        self._size = 0
+        self._items = OrderedDict()
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def get(self, url: str):
+        """
+        Get decoded logo for url
+        :return: ImageReader, or None if logo couldn't be loaded
+        """
+        with self._lock:
+            cached = self._items.get(url)
+            if cached is not None:
+                self._items.move_to_end(url)
+                return cached[0]
+
+            retry_after = self._failures.get(url)
+            if retry_after is not None:
+                if time.monotonic() < retry_after:
+                    return None
+                del self._failures[url]
+
+        return self._flights.do(url, self._load, url)
+
+    def _load(self, url: str):
+        try:
+            data = self._read_seed(url) or self._fetch(url)
+            image = ImageReader(io.BytesIO(data))
+            image.getRGBData()  # decode now, rather than on first render
+        except Exception as e:
+            print(f"could not load logo '{url}', not retrying for {self._failure_ttl}s: {e}")
+            with self._lock:
+                self._failures[url] = time.monotonic() + self._failure_ttl
+            return None
+
+        if len(data) <= self._max_bytes:
+            with self._lock:
+                self._items[url] = (image, len(data))
+                self._size += len(data)
+                while self._size > self._max_bytes:
+                    _, (_, evicted_size) = self._items.popitem(last=False)
+                    self._size -= evicted_size
+        return image
+
+    def _read_seed(self, url: str):
+        if not self._seed_dir:
+            return None
+
+        filename = os.path.basename(urllib.parse.urlparse(url).path)
+        path = os.path.join(self._seed_dir, filename)
+        if filename and os.path.isfile(path):
+            with open(path, "rb") as f:
+                return f.read()
+        return None
+
+    def _fetch(self, url: str):
+        print(f"fetching logo '{url}'")
+        with urllib.request.urlopen(url, timeout=self._timeout) as response:
+            return response.read()
+
+
+def logo_cache_from_env(default_seed_dir: str) -> LogoCache:
+    """
+    Configure cache from env vars:
+      LOGO_DIR - directory of bundled logos (default 'logos' next to generator)
+      LOGO_CACHE_BYTES - max size of logo images to hold (default 5MB)
+      LOGO_FETCH_TIMEOUT - timeout in seconds for fetching logos not bundled (default 10)
+      LOGO_FAILURE_TTL - seconds to render without a logo that couldn't be loaded before trying again (default 60)
+    """
+    return LogoCache(os.environ.get("LOGO_DIR", default_seed_dir),
+                     int(os.environ.get("LOGO_CACHE_BYTES", 5 * 1024 * 1024)),
+                     float(os.environ.get("LOGO_FETCH_TIMEOUT", 10)),
+                     float(os.environ.get("LOGO_FAILURE_TTL", 60)))
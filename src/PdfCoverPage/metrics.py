@@ -0,0 +1,295 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on windows, snapshots of exited processes aren't folded into RETIRED
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (10_000, 25_000, 50_000, 100_000, 250_000, 1_000_000, 5_000_000, 25_000_000)
+# snapshot_dir file with the summed values of processes that have exited
+RETIRED = "retired.json"
+
+
+class CountingReader:
+    """Wraps file-like object, e.g. S3 StreamingBody, counting bytes read"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes_read = 0
+
+    def read(self, n=-1):
+        data = self._stream.read(n)
+        self.bytes_read += len(data)
+        return data
+
+
+class Metrics:
+    """
+    Counters + histograms, rendered in Prometheus text format. Values are per-process, if snapshot_dir is set each
+    process writes its values there after every request and render() sums all processes, so it doesn't matter which
+    uwsgi worker serves the request for metrics. Snapshots are named {pid}-{start}.json, so a process reusing the pid
+    of one that exited doesn't overwrite its values, and render() folds snapshots of exited processes into RETIRED.
+    Processes are checked by pid, so snapshot_dir must only be shared by processes on the same host.
+
+    Also tracks the current request per thread (start_request/finish_request), collecting stage timings for a
+    structured log line
+    """
+
+    def __init__(self, snapshot_dir: str = None):
+        self._snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._local = threading.local()
+        self._snapshot_name = None
+        self._snapshot_pid = None
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+    def describe(self, name: str, kind: str, description: str, buckets: tuple = None):
+        """Register metric, kind is 'counter' or 'histogram'. Histograms need buckets"""
+        self._descriptions[name] = (kind, description, buckets)
+
+    def add_collector(self, collector):
+        """Register function returning iterable of (counter name, labels dict, value), called when values are read"""
+        self._collectors.append(collector)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._descriptions[name][2]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # count per bucket, then sum + count
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        """Time a stage of request, recorded in pdf_cover_stage_seconds and the current request's timings"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, self.current_request())
+
+    def record_stage(self, stage: str, seconds: float, record: dict = None):
+        self.observe("pdf_cover_stage_seconds", seconds, stage=stage)
+        if record is not None:
+            record["timings"][stage] = record["timings"].get(stage, 0) + seconds
+
+    def start_request(self, **fields) -> dict:
+        record = {**fields, "timings": {}, "_start": time.perf_counter()}
+        self._local.record = record
+        return record
+
+    def current_request(self):
+        return getattr(self._local, "record", None)
+
+    def finish_request(self, record: dict, status: int, **fields):
+        """Record request outcome and write structured log line for it"""
+        self._local.record = None
+        total = time.perf_counter() - record.pop("_start")
+        self.increment("pdf_cover_requests_total", status=str(status))
+        self.observe("pdf_cover_request_seconds", total)
+
+        record.update(fields)
+        record["status"] = status
+        record["timings"] = {stage: round(seconds, 4) for stage, seconds in record["timings"].items()}
+        record["timings"]["total"] = round(total, 4)
+        print(json.dumps({"event": "pdf-cover", **record}))
+
+        if self._snapshot_dir:
+            self.write_snapshot()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                counters[(name, tuple(sorted(labels.items())))] = value
+        return {"counters": counters, "histograms": histograms}
+
+    def write_snapshot(self):
+        self._write(self.snapshot_name(), self.snapshot())
+
+    def snapshot_name(self) -> str:
+        """This process's snapshot file, named on first use in each process (after uwsgi forks workers)"""
+        pid = os.getpid()
+        if self._snapshot_pid != pid:
+            self._snapshot_name = f"{pid}-{time.time_ns()}.json"
+            self._snapshot_pid = pid
+        return self._snapshot_name
+
+    def _write(self, filename: str, snapshot: dict, **extra):
+        content = json.dumps({
+            **extra,
+            **{kind: [[name, list(labels), values] for (name, labels), values in snapshot[kind].items()]
+               for kind in ("counters", "histograms")},
+        })
+        fd, temp_path = tempfile.mkstemp(dir=self._snapshot_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(temp_path, os.path.join(self._snapshot_dir, filename))
+
+    def _read(self, filename: str):
+        """Snapshot in filename and the other fields written with it, (None, None) if it's missing or unreadable"""
+        try:
+            with open(os.path.join(self._snapshot_dir, filename)) as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        snapshot = {
+            kind: {(name, tuple(tuple(label) for label in labels)): values
+                   for name, labels, values in content.pop(kind)}
+            for kind in ("counters", "histograms")
+        }
+        return snapshot, content
+
+    def _read_snapshots(self):
+        """Snapshots written by other processes, and RETIRED"""
+        own = self.snapshot_name()
+        for filename in os.listdir(self._snapshot_dir):
+            if not filename.endswith(".json") or filename == own:
+                continue
+            snapshot, _ = self._read(filename)
+            if snapshot is not None:
+                yield snapshot
+
+    @contextlib.contextmanager
+    def _fold_lock(self):
+        """Held while folding snapshots into RETIRED and while reading them, so none is read twice or missed"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self._snapshot_dir, "fold.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fold_exited(self):
+        """
+        Add snapshots of processes that have exited to RETIRED and remove them, so their values are still counted
+        without a file for every process that has ever run. Called with _fold_lock held
+        """
+        if fcntl is None:
+            return
+        exited = [filename for filename in os.listdir(self._snapshot_dir) if not is_running(snapshot_pid(filename))]
+        if not exited:
+            return
+        retired, fields = self._read(RETIRED)
+        if retired is None:
+            retired, fields = {"counters": {}, "histograms": {}}, {}
+        # already in RETIRED, but the process folding them stopped before removing them
+        for filename in fields.get("folded", []):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self._snapshot_dir, filename))
+        folded = []
+        for filename in exited:
+            snapshot, _ = self._read(filename)
+            if snapshot is not None:
+                add_snapshot(retired, snapshot)
+                folded.append(filename)
+        self._write(RETIRED, retired, folded=folded)
+        for filename in folded:
+            os.remove(os.path.join(self._snapshot_dir, filename))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+        combined = self.snapshot()
+        if self._snapshot_dir:
+            with self._fold_lock():
+                self._fold_exited()
+                for other in self._read_snapshots():
+                    add_snapshot(combined, other)
+
+        lines = []
+        for name, (kind, description, buckets) in self._descriptions.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (sample_name, labels), value in sorted(combined["counters"].items()):
+                    if sample_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for (sample_name, labels), values in sorted(combined["histograms"].items()):
+                    if sample_name != name:
+                        continue
+                    for bound, count in zip(buckets, values):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def add_snapshot(combined: dict, other: dict):
+    """Add values in snapshot other to combined"""
+    for key, value in other["counters"].items():
+        combined["counters"][key] = combined["counters"].get(key, 0) + value
+    for key, values in other["histograms"].items():
+        existing = combined["histograms"].get(key)
+        combined["histograms"][key] = [a + b for a, b in zip(existing, values)] if existing else values
+
+
+def snapshot_pid(filename: str):
+    """pid of process that wrote snapshot file {pid}-{start}.json, None for RETIRED and other files"""
+    pid = filename.split("-")[0]
+    return int(pid) if filename.endswith(".json") and "-" in filename and pid.isdigit() else None
+
+
+def is_running(pid) -> bool:
+    """Whether process pid exists on this host. True for None, so files that aren't snapshots are left alone"""
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to another user
+        return True
+    return True
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def metrics_from_env() -> Metrics:
+    """
+    Configure metrics from env vars:
+      METRICS_DIR - directory for processes to share metrics through, if not set metrics are per-process
+    """
+    metrics = Metrics(os.environ.get("METRICS_DIR"))
+    metrics.describe("pdf_cover_requests_total", "counter", "Cover-page requests by response status")
+    metrics.describe("pdf_cover_request_seconds", "histogram", "Total time to handle cover-page request",
+                     STAGE_BUCKETS)
+    metrics.describe("pdf_cover_stage_seconds", "histogram", "Time spent in each stage of handling request",
+                     STAGE_BUCKETS)
+    metrics.describe("pdf_cover_manifest_bytes", "histogram", "Bytes of manifest read from S3", SIZE_BUCKETS)
+    metrics.describe("pdf_cover_pdf_bytes", "histogram", "Size of cover-page PDFs returned", SIZE_BUCKETS)
+    metrics.describe("pdf_cover_cache_requests_total", "counter", "Cache lookups by cache and result")
+    return metrics
@@ -0,0 +1,155 @@
+"""
+Pre-render PDF cover-pages into the shared cover-page cache, e.g. to warm everything after a bulk rebuild so the first
+request for each work doesn't pay for S3 + rendering. Needs PDF_CACHE_DIR and/or PDF_CACHE_BUCKET to be set.
+
+    # identifiers from file, 1 per line
+    python pregenerate.py --identifiers identifiers.txt --processes 8 --done-file done.jsonl
+
+    # every manifest under {KEY_PREFIX}/b1
+    python pregenerate.py --prefix b1 --processes 8 --done-file done.jsonl
+
+Each outcome is appended to --done-file, rerunning with the same file skips identifiers already done.
+"""
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# in-process caches are of no use to a batch job, renders need to go to a shared tier
+os.environ.setdefault("PDF_CACHE_MEMORY_BYTES", "0")
+os.environ.setdefault("FIELDS_CACHE_ITEMS", "0")
+
+import generator  # noqa: E402
+
+# how many identifiers to queue per process
+QUEUED_PER_PROCESS = 4
+
+
+def identifiers_from_file(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if identifier := line.strip():
+                yield identifier
+
+
+def identifiers_from_prefix(prefix: str):
+    """Yield identifiers of all manifests in S3 starting with {KEY_PREFIX}/{prefix}"""
+    key_start = f"{generator.key_prefix}/"
+    paginator = generator.get_s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=generator.manifest_bucket, Prefix=f"{key_start}{prefix}"):
+        for s3_object in page.get("Contents", []):
+            yield s3_object["Key"][len(key_start):]
+
+
+def read_done(path: str) -> set:
+    """Get identifiers from done-file that don't need to be processed again, everything but errors"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # partial line from interrupted run
+            if entry["status"] != "error":
+                done.add(entry["identifier"])
+    return done
+
+
+def pregenerate(identifier: str) -> dict:
+    """Render cover-page for identifier into cache, unless already there"""
+    start = time.perf_counter()
+    try:
+        cover_page = generator.get_cover_page(identifier)
+        if cover_page is None:
+            status = "not_found"
+        else:
+            status = "rendered" if cover_page[2] else "cached"
+    except Exception as e:
+        print(f"error pre-generating cover-page for '{identifier}': {e}")
+        status = "error"
+
+    return {"identifier": identifier, "status": status, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def log_progress(counts: dict, elapsed: float):
+    processed = sum(count for status, count in counts.items() if status != "skipped")
+    rate = processed / elapsed if elapsed else 0
+    by_status = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+    print(f"processed {processed} in {elapsed:.0f}s ({rate:.1f}/sec) - {by_status}")
+
+
+def run(identifiers, processes: int, done_path: str = None, report_interval: float = 30):
+    """
+    Pre-render cover-pages for identifiers across a pool of processes
+    :param identifiers: iterable of identifiers, consumed lazily
+    :param processes: number of worker processes
+    :param done_path: optional done-file, identifiers in it are skipped and outcomes are appended to it
+    :param report_interval: seconds between progress logs
+    :return: dict of status: count
+    """
+    done = read_done(done_path) if done_path else set()
+    if done:
+        print(f"Resuming, skipping {len(done)} identifiers already in {done_path}")
+
+    counts = {}
+    start = last_report = time.perf_counter()
+
+    with open(done_path, "a", encoding="utf-8") if done_path else contextlib.nullcontext() as done_file:
+        def collect(futures):
+            for future in futures:
+                result = future.result()
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+                if done_file:
+                    done_file.write(json.dumps(result) + "\n")
+                    done_file.flush()
+
+        with ProcessPoolExecutor(processes) as executor:
+            pending = set()
+            for identifier in identifiers:
+                if identifier in done:
+                    counts["skipped"] = counts.get("skipped", 0) + 1
+                    continue
+                done.add(identifier)
+                pending.add(executor.submit(pregenerate, identifier))
+
+                # only queue a few per process so a long listing isn't held in memory as futures
+                if len(pending) >= processes * QUEUED_PER_PROCESS:
+                    completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(completed)
+
+                    if time.perf_counter() - last_report >= report_interval:
+                        log_progress(counts, time.perf_counter() - start)
+                        last_report = time.perf_counter()
+
+            completed, _ = wait(pending)
+            collect(completed)
+
+    log_progress(counts, time.perf_counter() - start)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-render PDF cover-pages into the shared cache")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--identifiers", help="file containing identifiers to pre-render, 1 per line")
+    source.add_argument("--prefix", help="pre-render every manifest with key starting {KEY_PREFIX}/{prefix}")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--done-file", help="JSONL file to record outcomes to, and resume from")
+    parser.add_argument("--report-interval", type=float, default=30, help="seconds between progress logs")
+    args = parser.parse_args()
+
+    if not os.environ.get("PDF_CACHE_DIR") and not os.environ.get("PDF_CACHE_BUCKET"):
+        parser.error("PDF_CACHE_DIR and/or PDF_CACHE_BUCKET must be set to pre-render into a shared cache")
+
+    if args.identifiers:
+        identifiers = identifiers_from_file(args.identifiers)
+    else:
+        identifiers = identifiers_from_prefix(args.prefix)
+
+    run(identifiers, args.processes, args.done_file, args.report_interval)
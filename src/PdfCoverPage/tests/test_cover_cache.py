@@ -0,0 +1,164 @@
+"""
+Tiers of the rendered cover-page cache, with moto in place of S3 and a temporary directory for the disk tier:
+
+    pip install -r requirements-test.txt
+    python -m unittest discover tests
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cover_cache  # noqa: E402
+from cover_cache import CoverCache, DiskTier, FileLocks, MemoryTier, S3Tier  # noqa: E402
+
+REGION = "eu-west-1"
+BUCKET = "covers"
+PDF = b"%PDF-1.4 cover page"
+
+
+class CoverCacheTest(unittest.TestCase):
+    def setUp(self):
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+            os.environ[name] = "testing"
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        self.s3 = boto3.client("s3", region_name=REGION)
+        self.s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": REGION})
+
+    def tiers(self, bucket=BUCKET):
+        return [MemoryTier(1024), DiskTier(self.directory, 1024), S3Tier(lambda: self.s3, bucket, "pdf-cover/")]
+
+    def test_hit_in_slower_tier_copied_to_faster(self):
+        memory, disk, s3 = tiers = self.tiers()
+        s3.put("key", PDF)
+        cache = CoverCache(tiers)
+
+        self.assertEqual(cache.get("key"), PDF)
+        self.assertEqual(memory.get("key"), PDF)
+        self.assertEqual(disk.get("key"), PDF)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_miss_rendered_once_and_put_in_every_tier(self):
+        render = mock.Mock(return_value=PDF)
+        cache = CoverCache(self.tiers())
+
+        self.assertEqual(cache.get_or_render("key", render), (PDF, True))
+        self.assertEqual(cache.get_or_render("key", render), (PDF, False))
+        render.assert_called_once_with()
+        self.assertEqual(self.s3.get_object(Bucket=BUCKET, Key="pdf-cover/key.pdf")["Body"].read(), PDF)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_s3_client_error_is_miss(self):
+        cache = CoverCache(self.tiers(bucket="missing-bucket"))
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(cache.get_or_render("key", lambda: PDF), (PDF, True))
+        self.assertIn("NoSuchBucket", output.getvalue())
+        # other tiers still cached it
+        self.assertEqual(cache.get_or_render("key", lambda: b"not rendered again"), (PDF, False))
+
+    def test_s3_connection_error_is_miss(self):
+        client = mock.Mock()
+        client.get_object.side_effect = client.put_object.side_effect = \
+            EndpointConnectionError(endpoint_url="https://s3.eu-west-1.amazonaws.com")
+        s3 = S3Tier(lambda: client, BUCKET)
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertIsNone(s3.get("key"))
+            s3.put("key", PDF)
+        self.assertEqual(output.getvalue().count("Could not connect"), 2)
+
+    def test_disk_tier_evicts_least_recently_used(self):
+        disk = DiskTier(self.directory, 2 * len(PDF))
+        disk.put("a", PDF)
+        disk.put("b", PDF)
+        os.utime(os.path.join(self.directory, "a.pdf"), (1000, 1000))
+        os.utime(os.path.join(self.directory, "b.pdf"), (2000, 2000))
+
+        # reading 'a' makes 'b' least recently used
+        self.assertEqual(disk.get("a"), PDF)
+        disk.put("c", PDF)
+
+        self.assertIsNone(disk.get("b"))
+        self.assertEqual(disk.get("a"), PDF)
+        self.assertEqual(disk.get("c"), PDF)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["a.pdf", "c.pdf"])
+
+
+@unittest.skipIf(cover_cache.fcntl is None, "renders aren't coalesced across processes without fcntl")
+class FileLocksTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.locks = FileLocks(self.directory)
+
+    def test_lock_file_removed_before_unlock(self):
+        lock_path = os.path.join(self.directory, "key.lock")
+        flock = cover_cache.fcntl.flock
+        exists_at_unlock = []
+
+        def watched_flock(f, operation):
+            if operation == cover_cache.fcntl.LOCK_UN:
+                exists_at_unlock.append(os.path.exists(lock_path))
+            return flock(f, operation)
+
+        with mock.patch.object(cover_cache.fcntl, "flock", watched_flock):
+            with self.locks.lock("key"):
+                self.assertTrue(os.path.exists(lock_path))
+
+        self.assertEqual(exists_at_unlock, [False])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_lock_file_removed_when_render_fails(self):
+        with self.assertRaises(ValueError):
+            with self.locks.lock("key"):
+                raise ValueError("render failed")
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_renders_coalesced(self):
+        # flock is per open file, so threads contend for it like processes do
+        renders = []
+
+        def render():
+            renders.append(threading.current_thread().name)
+            time.sleep(0.1)
+            return PDF
+
+        cache_dir = os.path.join(self.directory, "cache")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            CoverCache([DiskTier(cache_dir, 1024)], FileLocks(cache_dir)).get_or_render("key", render)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(sorted(results), [(PDF, False)] * 3 + [(PDF, True)])
+        self.assertEqual(os.listdir(cache_dir), ["key.pdf"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Caching of the fields extracted from manifests, revalidated against moto in place of S3:
+
+    pip install -r requirements-test.txt
+    python -m unittest discover tests
+"""
+import io
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import generator  # noqa: E402
+from fields_cache import FieldsCache  # noqa: E402
+
+MANIFEST = {
+    "label": {"en": ["Test manifest"]},
+    "items": [{"id": f"https://iiif.wellcomecollection.org/canvases/c{i}"} for i in range(100)],
+}
+
+
+class FieldsCacheTest(unittest.TestCase):
+    def test_fresh_for_ttl(self):
+        cache = FieldsCache(10, ttl=60)
+        cache.put("b1234", {"label": ["Test manifest"]}, '"etag"')
+
+        cached = cache.get("b1234")
+        self.assertTrue(cached.is_fresh())
+        self.assertEqual(cached.etag, '"etag"')
+
+        cached.expires -= 61
+        self.assertFalse(cached.is_fresh())
+        cache.refresh("b1234")
+        self.assertTrue(cache.get("b1234").is_fresh())
+
+    def test_least_recently_used_evicted(self):
+        cache = FieldsCache(2, ttl=60)
+        cache.put("b1", {}, None)
+        cache.put("b2", {}, None)
+        cache.get("b1")
+        cache.put("b3", {}, None)
+
+        self.assertIsNone(cache.get("b2"))
+        self.assertIsNotNone(cache.get("b1"))
+        self.assertIsNotNone(cache.get("b3"))
+
+    def test_disabled(self):
+        cache = FieldsCache(0, ttl=60)
+        cache.put("b1", {}, None)
+        self.assertIsNone(cache.get("b1"))
+
+
+class ReadRequiredTopLevelTest(unittest.TestCase):
+    def test_only_top_level_required_keys(self):
+        manifest = {
+            "id": "https://iiif.wellcomecollection.org/presentation/b1234",
+            "items": [{"label": {"en": ["page 1"]}, "metadata": [], "items": [{"provider": []}]}],
+            "label": {"en": ["Test manifest"]},
+            "metadata": [{"label": {"en": ["Date"]}, "value": {"en": ["1900"]}}],
+            "structures": [],
+        }
+        stream = io.BytesIO(json.dumps(manifest).encode())
+
+        self.assertEqual(generator.read_required_top_level(stream),
+                         {"label": manifest["label"], "metadata": manifest["metadata"]})
+
+    def test_stops_reading_once_all_read(self):
+        manifest = {key: [{"value": key}] for key in generator.REQUIRED_KEYS}
+        # rest of manifest is never parsed, so needn't be complete
+        body = json.dumps(manifest).encode().rstrip(b"}")
+        stream = io.BytesIO(body + b', "items": [' + b'{"id": "canvas"}, ' * 100_000)
+
+        self.assertEqual(generator.read_required_top_level(stream), manifest)
+        self.assertLess(stream.tell(), len(body) + 100_000)
+
+
+class RevalidationTest(unittest.TestCase):
+    def setUp(self):
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+            os.environ[name] = "testing"
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+
+        # client from an earlier test would have been created outside this mock
+        generator._s3_client = generator._s3_client_pid = None
+        self.addCleanup(setattr, generator, "_s3_client_pid", None)
+
+        self.fields_cache = FieldsCache(10, ttl=60)
+        patcher = mock.patch.object(generator, "fields_cache", self.fields_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.s3 = boto3.client("s3", region_name=generator.region)
+        self.s3.create_bucket(Bucket=generator.manifest_bucket,
+                              CreateBucketConfiguration={"LocationConstraint": generator.region})
+        self.put_manifest(MANIFEST)
+
+    def put_manifest(self, manifest):
+        self.s3.put_object(Bucket=generator.manifest_bucket, Key=f"{generator.key_prefix}/b1234",
+                           Body=json.dumps(manifest).encode())
+
+    def expire(self):
+        self.fields_cache.get("b1234").expires = 0
+
+    def counts(self):
+        return self.fields_cache.hits, self.fields_cache.revalidated, self.fields_cache.misses
+
+    def test_fresh_fields_not_fetched(self):
+        fields = generator.get_required_fields("b1234")
+        with mock.patch.object(generator, "get_manifest") as get_manifest:
+            self.assertIs(generator.get_required_fields("b1234"), fields)
+        get_manifest.assert_not_called()
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_stale_fields_revalidated_without_download(self):
+        fields = generator.get_required_fields("b1234")
+        self.expire()
+
+        with mock.patch.object(generator, "read_required_top_level") as read_required_top_level:
+            self.assertIs(generator.get_required_fields("b1234"), fields)
+        read_required_top_level.assert_not_called()
+        self.assertTrue(self.fields_cache.get("b1234").is_fresh())
+        self.assertEqual(self.counts(), (0, 1, 1))
+
+    def test_changed_manifest_fetched_again(self):
+        generator.get_required_fields("b1234")
+        self.put_manifest({**MANIFEST, "label": {"en": ["Changed"]}})
+        self.expire()
+
+        self.assertEqual(generator.get_required_fields("b1234"), {"label": ["Changed"]})
+        self.assertEqual(self.counts(), (0, 0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
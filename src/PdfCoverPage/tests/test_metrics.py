@@ -0,0 +1,111 @@
+"""
+Summing metrics across processes through snapshot files:
+
+    python -m unittest discover tests
+"""
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metrics  # noqa: E402
+from metrics import RETIRED, Metrics  # noqa: E402
+
+# start times of fake processes
+STARTS = itertools.count()
+
+
+def exited_pid():
+    """pid of a process that has exited"""
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def process_metrics(self, pid=None):
+        """Metrics as seen from process pid"""
+        m = Metrics(self.directory)
+        m.describe("requests_total", "counter", "Requests")
+        m.describe("request_seconds", "histogram", "Request time", (0.1, 1))
+        if pid is not None:
+            m._snapshot_name, m._snapshot_pid = f"{pid}-{next(STARTS)}.json", os.getpid()
+        return m
+
+    def record_request(self, m, seconds=0.05):
+        m.increment("requests_total", status="200")
+        m.observe("request_seconds", seconds)
+        m.write_snapshot()
+
+    def assertRendered(self, m, requests, histogram):
+        rendered = m.render()
+        self.assertIn(f'requests_total{{status="200"}} {requests}\n', rendered)
+        for bound, count in zip(("0.1", "1", "+Inf"), histogram):
+            self.assertIn(f'request_seconds_bucket{{le="{bound}"}} {count}\n', rendered)
+
+    def test_processes_summed(self):
+        first, second = self.process_metrics(), self.process_metrics(pid=os.getppid())
+        self.record_request(first)
+        self.record_request(second, seconds=0.5)
+        self.record_request(second, seconds=5)
+
+        self.assertRendered(first, 3, (1, 2, 3))
+        self.assertRendered(second, 3, (1, 2, 3))
+        self.assertEqual(len(os.listdir(self.directory)), 3)  # snapshots + lock file
+
+    def test_reused_pid_doesnt_overwrite(self):
+        with mock.patch.object(metrics.time, "time_ns", side_effect=[1, 2]):
+            before, after = self.process_metrics(), self.process_metrics()
+            self.record_request(before)
+            self.record_request(after)
+
+        self.assertNotEqual(before.snapshot_name(), after.snapshot_name())
+        self.assertRendered(after, 2, (2, 2, 2))
+
+    @unittest.skipIf(metrics.fcntl is None, "snapshots of exited processes aren't folded without fcntl")
+    def test_exited_processes_folded(self):
+        pid = exited_pid()
+        self.record_request(self.process_metrics(pid=pid))
+        self.record_request(self.process_metrics(pid=pid), seconds=0.5)
+        current = self.process_metrics()
+        self.record_request(current, seconds=5)
+
+        self.assertRendered(current, 3, (1, 2, 3))
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([current.snapshot_name(), RETIRED, "fold.lock"]))
+
+        # added to the values already retired
+        self.record_request(self.process_metrics(pid=exited_pid()))
+        self.assertRendered(current, 4, (2, 3, 4))
+        self.assertRendered(current, 4, (2, 3, 4))
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    @unittest.skipIf(metrics.fcntl is None, "snapshots of exited processes aren't folded without fcntl")
+    def test_folded_snapshot_not_counted_again(self):
+        exited = self.process_metrics(pid=exited_pid())
+        self.record_request(exited)
+        path = os.path.join(self.directory, exited.snapshot_name())
+        with open(path) as f:
+            content = f.read()
+        current = self.process_metrics()
+        self.assertRendered(current, 1, (1, 1, 1))
+        self.assertFalse(os.path.exists(path))
+
+        # as if the process folding it stopped before removing it
+        with open(path, "w") as f:
+            f.write(content)
+        self.assertRendered(current, 1, (1, 1, 1))
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
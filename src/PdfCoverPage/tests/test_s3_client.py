@@ -0,0 +1,66 @@
+"""
+get_s3_client() against moto, a local S3 stand-in, so no AWS access is needed:
+
+    pip install -r requirements-test.txt
+    python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import generator  # noqa: E402
+
+MANIFEST = {
+    "label": {"en": ["Test manifest"]},
+    "provider": [{"logo": [{"id": "https://iiif.wellcomecollection.org/logos/wellcome-collection-black.png"}]}],
+}
+
+
+class S3ClientTest(unittest.TestCase):
+    def setUp(self):
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+            os.environ[name] = "testing"
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+
+        # client from an earlier test would have been created outside this mock
+        generator._s3_client = generator._s3_client_pid = None
+        self.addCleanup(setattr, generator, "_s3_client_pid", None)
+
+        s3 = boto3.client("s3", region_name=generator.region)
+        s3.create_bucket(Bucket=generator.manifest_bucket,
+                         CreateBucketConfiguration={"LocationConstraint": generator.region})
+        s3.put_object(Bucket=generator.manifest_bucket, Key=f"{generator.key_prefix}/b1234",
+                      Body=json.dumps(MANIFEST).encode())
+
+    def test_client_reused_within_process(self):
+        self.assertIs(generator.get_s3_client(), generator.get_s3_client())
+
+    def test_client_recreated_after_pid_changes(self):
+        client = generator.get_s3_client()
+        # as seen by a uwsgi worker forked after the client was created
+        with mock.patch.object(generator.os, "getpid", return_value=os.getpid() + 1):
+            worker_client = generator.get_s3_client()
+            self.assertIsNot(worker_client, client)
+            self.assertIs(generator.get_s3_client(), worker_client)
+
+    def test_get_manifest_creates_client_once(self):
+        with mock.patch.object(generator.boto3.session, "Session", wraps=boto3.session.Session) as session:
+            for _ in range(3):
+                manifest, _ = generator.get_manifest("b1234")
+                self.assertEqual(manifest["label"], MANIFEST["label"])
+
+        self.assertEqual(session.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Coalescing of concurrent renders of the same cover-page:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import single_flight  # noqa: E402
+from single_flight import SingleFlight  # noqa: E402
+
+FOLLOWERS = 3
+# seconds to wait for threads before failing rather than hanging
+TIMEOUT = 10
+
+
+class WatchedEvent(threading.Event):
+    """Event that signals 'waiting' whenever a thread starts waiting on it"""
+    waiting = None
+
+    def wait(self, timeout=None):
+        WatchedEvent.waiting.release()
+        return super().wait(timeout)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        WatchedEvent.waiting = threading.Semaphore(0)
+        patcher = mock.patch.object(single_flight, "threading",
+                                    types.SimpleNamespace(Lock=threading.Lock, Event=WatchedEvent))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.flight = SingleFlight()
+        self.leader_started = threading.Event()
+        self.leader_release = threading.Event()
+
+    def leader(self, outcome):
+        self.leader_started.set()
+        self.assertTrue(self.leader_release.wait(TIMEOUT))
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    def follower(self):
+        raise AssertionError("follower ran its own render")
+
+    def run_concurrently(self, outcome):
+        """Run leader + FOLLOWERS for the same key, releasing the leader once all followers are waiting for it"""
+        outcomes = {}
+
+        def call(name, fn, *args):
+            try:
+                outcomes[name] = self.flight.do("b1234", fn, *args)
+            except BaseException as e:
+                outcomes[name] = e
+
+        threads = [threading.Thread(target=call, args=("leader", self.leader, outcome))]
+        threads[0].start()
+        self.assertTrue(self.leader_started.wait(TIMEOUT))
+        for i in range(FOLLOWERS):
+            threads.append(threading.Thread(target=call, args=(f"follower {i}", self.follower)))
+            threads[-1].start()
+        for _ in range(FOLLOWERS):
+            self.assertTrue(WatchedEvent.waiting.acquire(timeout=TIMEOUT))
+
+        self.leader_release.set()
+        for thread in threads:
+            thread.join(TIMEOUT)
+        return outcomes
+
+    def test_followers_share_result(self):
+        pdf = b"%PDF-1.4 cover page"
+        outcomes = self.run_concurrently(pdf)
+
+        self.assertEqual(len(outcomes), FOLLOWERS + 1)
+        for outcome in outcomes.values():
+            self.assertIs(outcome, pdf)
+
+    def test_followers_get_error(self):
+        error = ValueError("render failed")
+        outcomes = self.run_concurrently(error)
+
+        self.assertEqual(len(outcomes), FOLLOWERS + 1)
+        for outcome in outcomes.values():
+            self.assertIs(outcome, error)
+
+    def test_key_released_after_error(self):
+        with self.assertRaises(ValueError):
+            self.flight.do("b1234", self.raise_error)
+        self.assertEqual(self.flight.do("b1234", lambda: b"rendered"), b"rendered")
+
+    @staticmethod
+    def raise_error():
+        raise ValueError("render failed")
+
+
+if __name__ == '__main__':
+    unittest.main()
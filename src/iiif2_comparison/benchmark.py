@@ -0,0 +1,136 @@
+"""
+Benchmark main() against a synthetic corpus served locally, no network required.
+Reports items/sec, per-item latency, peak RSS and CPU time.
+
+    python benchmark.py --items 500 --canvases 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+
+import logzero
+
+from journal import read_entries
+from main import main
+from synthetic import StandInServer, make_corpus
+
+HOST = "127.0.0.1"
+
+
+def serve(corpus_args, port, identifiers_queue):
+    """
+    Generate + serve corpus from separate process, so neither count towards benchmark.
+    Top-level identifiers are put on queue once generated
+    """
+    identifiers, documents = make_corpus(**corpus_args)
+    server = StandInServer(documents, HOST, port)
+    del documents
+    identifiers_queue.put(identifiers)
+    asyncio.run(server.serve_forever())
+
+
+def wait_for_port(port, timeout=60):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"stand-in server not listening on {port} after {timeout}s")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))]
+
+
+def run_benchmark(corpus_args, port, **main_kwargs):
+    identifiers_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(corpus_args, port, identifiers_queue), daemon=True)
+    server.start()
+    try:
+        identifiers = identifiers_queue.get(timeout=600)
+        wait_for_port(port)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            journal_path = os.path.join(tmp, "benchmark.jsonl")
+
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            asyncio.run(main(identifiers, journal_path=journal_path,
+                             original_format=f"http://{HOST}:{port}/original/{{bnum}}",
+                             new_format=f"http://{HOST}:{port}/new/{{bnum}}", **main_kwargs))
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+
+            entries = list(read_entries(journal_path))
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies = [sum(entry["timings"].values()) for entry in entries]
+    statuses = {}
+    for entry in entries:
+        statuses[entry["status"]] = statuses.get(entry["status"], 0) + 1
+
+    return {
+        "items": len(entries),
+        "statuses": statuses,
+        "wall": wall,
+        "items_per_sec": len(entries) / wall if wall else 0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "cpu": cpu,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KiB on linux
+        "mb_downloaded": sum(entry["bytes"] for entry in entries) / 1024 / 1024,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark comparison engine against synthetic manifests")
+    parser.add_argument("--items", type=int, default=200, help="number of top-level items in corpus")
+    parser.add_argument("--canvases", type=int, default=100, help="canvases per image manifest")
+    parser.add_argument("--av-ratio", type=float, default=0.1)
+    parser.add_argument("--authed-ratio", type=float, default=0.2)
+    parser.add_argument("--collection-ratio", type=float, default=0.05)
+    parser.add_argument("--failure-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="log each comparison, as main.py does")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logzero.loglevel(logging.WARNING)
+
+    corpus = {
+        "items": args.items,
+        "canvases": args.canvases,
+        "av_ratio": args.av_ratio,
+        "authed_ratio": args.authed_ratio,
+        "collection_ratio": args.collection_ratio,
+        "failure_ratio": args.failure_ratio,
+        "seed": args.seed,
+        "base_uri": f"http://{HOST}:{args.port}",
+    }
+    report = run_benchmark(corpus, args.port, concurrency=args.concurrency, stream=args.stream)
+
+    print(f"items:        {report['items']} {report['statuses']}")
+    print(f"wall time:    {report['wall']:.2f}s")
+    print(f"throughput:   {report['items_per_sec']:.1f} items/sec")
+    print(f"latency p50:  {report['p50'] * 1000:.1f}ms")
+    print(f"latency p95:  {report['p95'] * 1000:.1f}ms")
+    print(f"cpu time:     {report['cpu']:.2f}s")
+    print(f"peak rss:     {report['peak_rss_mb']:.1f}MB")
+    print(f"downloaded:   {report['mb_downloaded']:.1f}MB")
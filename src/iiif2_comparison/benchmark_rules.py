@@ -0,0 +1,62 @@
+"""
+Micro-benchmark for rule lookups in the comparison walk.
+Compares looking up + building rule lists from 'rules' for every element (as the walk used to) against
+the compiled per-level rules, then times a full comparison of a large manifest.
+
+    python benchmark_rules.py --canvases 2000
+"""
+import argparse
+import asyncio
+import logging
+import timeit
+
+import logzero
+
+from main import Comparer, get_level_rules, rules
+from synthetic import image_manifest
+
+LEVEL = "sequences-canvases-images-resource-service"
+KEYS = ["@context", "@id", "profile", "width", "height", "protocol", "service"]
+
+
+def uncompiled_lookup():
+    for key in KEYS:
+        rules_for_level = rules.get(LEVEL, {})
+        ignore = rules_for_level.get("ignore", [])
+        version_insensitive = rules_for_level.get("version_insensitive", [])
+        domain_insensitive = rules_for_level.get("domain_insensitive", [])
+        bnumber_insensitive = rules_for_level.get("bnumber_insensitive", [])
+        dlcs_comparison = rules_for_level.get("dlcs_comparison", [])
+        _ = key in ignore or key in version_insensitive or key in domain_insensitive or \
+            key in bnumber_insensitive or key in dlcs_comparison
+        _ = rules.get(f"{LEVEL}-{key}", {}).get("order_by", "")
+
+
+def compiled_lookup():
+    for key in KEYS:
+        level_rules = get_level_rules(LEVEL)
+        _ = key in level_rules.ignore or level_rules.strategies.get(key)
+        _ = get_level_rules(Comparer.get_next_level(LEVEL, key)).order_by
+
+
+def time_comparison(canvases, repeat):
+    comparer = Comparer(None)
+    original = image_manifest("b1000000x", canvases, is_new=False)
+    new = image_manifest("b1000000x", canvases, is_new=True)
+    return min(timeit.repeat(lambda: asyncio.run(comparer.start_comparison(original, new)), number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark rule lookups")
+    parser.add_argument("--canvases", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    logzero.loglevel(logging.WARNING)
+
+    number = 20_000
+    uncompiled = min(timeit.repeat(uncompiled_lookup, number=number, repeat=args.repeat))
+    compiled = min(timeit.repeat(compiled_lookup, number=number, repeat=args.repeat))
+    print(f"uncompiled rule lookup: {uncompiled / number / len(KEYS) * 1e6:.3f}us per key")
+    print(f"compiled rule lookup: {compiled / number / len(KEYS) * 1e6:.3f}us per key ({uncompiled / compiled:.1f}x)")
+    print(f"compare {args.canvases} canvases: {time_comparison(args.canvases, args.repeat):.3f}s")
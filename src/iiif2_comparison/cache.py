@@ -0,0 +1,78 @@
+import fnmatch
+import sqlite3
+import time
+import zlib
+from urllib.parse import urlparse
+
+
+class CachedResponse:
+    def __init__(self, body, etag, last_modified, fetched, ttl):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.ttl = ttl
+
+    @property
+    def is_fresh(self):
+        """Whether this response can be used without revalidating. A ttl of None means cache forever"""
+        return self.ttl is None or time.time() - self.fetched < self.ttl
+
+
+class ResponseCache:
+    """
+    Persistent cache of HTTP response bodies, keyed by uri and stored compressed in a sqlite file.
+    Stores ETag + Last-Modified so stale entries can be revalidated with a conditional GET.
+    """
+
+    def __init__(self, path, ttls):
+        """
+        :param path: location of sqlite file, created if it doesn't exist
+        :param ttls: list of (host pattern, seconds) tuples, first matching pattern wins. None = never expires
+        """
+        self._ttls = ttls
+        self._connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(uri TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, fetched REAL)")
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def close(self):
+        self._connection.close()
+
+    def ttl_for(self, uri):
+        host = urlparse(uri).hostname or ""
+        for pattern, ttl in self._ttls:
+            if fnmatch.fnmatch(host, pattern):
+                return ttl
+        return 0
+
+    def get(self, uri):
+        row = self._connection.execute(
+            "SELECT body, etag, last_modified, fetched FROM responses WHERE uri = ?", (uri,)).fetchone()
+        if not row:
+            return None
+
+        body, etag, last_modified, fetched = row
+        return CachedResponse(zlib.decompress(body), etag, last_modified, fetched, self.ttl_for(uri))
+
+    def put(self, uri, body, etag=None, last_modified=None):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (uri, body, etag, last_modified, fetched) VALUES (?, ?, ?, ?, ?)",
+            (uri, zlib.compress(body), etag, last_modified, time.time()))
+
+    def delete(self, uri):
+        self._connection.execute("DELETE FROM responses WHERE uri = ?", (uri,))
+
+    def touch(self, uri):
+        """Mark cached response as freshly validated"""
+        self._connection.execute("UPDATE responses SET fetched = ? WHERE uri = ?", (time.time(), uri))
+
+    def summary(self):
+        total = self.hits + self.revalidated + self.misses
+        return f"cache: {total} requests, {self.hits} hits, {self.revalidated} revalidated, {self.misses} misses"
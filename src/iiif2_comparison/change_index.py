@@ -0,0 +1,78 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def content_hash(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def settings_fingerprint(*settings):
+    """Hash of anything, other than the manifests, that affects the result of a comparison. Must be json serialisable"""
+    return content_hash(json.dumps(settings, sort_keys=True).encode())
+
+
+class ContentVersion:
+    """Identifies a version of a manifest: hash of its content and the ETag/Last-Modified it was served with"""
+
+    def __init__(self, content_hash, etag=None, last_modified=None):
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class IndexedResult:
+    def __init__(self, original, new, entry):
+        self.original = original
+        self.new = new
+        self.entry = entry
+
+
+class ChangeIndex:
+    """
+    Persistent index of the versions of original + new manifest each b-number was last compared against, and the
+    result, stored in a sqlite file. A b-number whose manifests haven't changed since can reuse that result.
+    Results are only reused if compared with the same settings, e.g. rules, see settings_fingerprint.
+    """
+
+    def __init__(self, path, fingerprint):
+        """
+        :param path: location of sqlite file, created if it doesn't exist
+        :param fingerprint: settings_fingerprint of current run, results recorded with other settings aren't used
+        """
+        self._fingerprint = fingerprint
+        self._connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(bnumber TEXT PRIMARY KEY, fingerprint TEXT, "
+            "original_hash TEXT, original_etag TEXT, original_last_modified TEXT, "
+            "new_hash TEXT, new_etag TEXT, new_last_modified TEXT, entry TEXT, compared REAL)")
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, bnumber):
+        """Get last result for bnumber, None if there isn't one or it was compared with different settings"""
+        row = self._connection.execute(
+            "SELECT original_hash, original_etag, original_last_modified, new_hash, new_etag, new_last_modified, "
+            "entry FROM results WHERE bnumber = ? AND fingerprint = ?", (bnumber, self._fingerprint)).fetchone()
+        if not row:
+            return None
+
+        return IndexedResult(ContentVersion(*row[0:3]), ContentVersion(*row[3:6]), json.loads(row[6]))
+
+    def put(self, bnumber, original, new, entry):
+        """
+        :param original: ContentVersion of original manifest compared
+        :param new: ContentVersion of new manifest compared
+        :param entry: result, as recorded in journal
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO results (bnumber, fingerprint, original_hash, original_etag, "
+            "original_last_modified, new_hash, new_etag, new_last_modified, entry, compared) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (bnumber, self._fingerprint, original.content_hash, original.etag, original.last_modified,
+             new.content_hash, new.etag, new.last_modified, json.dumps(entry), time.time()))
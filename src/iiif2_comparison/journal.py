@@ -0,0 +1,53 @@
+import json
+import os
+
+
+class Journal:
+    """
+    Append-only JSONL file of comparison results, 1 line per b-number written as soon as the result is known.
+    Used to resume interrupted runs.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        needs_newline = False
+        if os.path.exists(self._path) and os.path.getsize(self._path):
+            # a crash mid-write leaves a partial line, start on a fresh one
+            with open(self._path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        self._file = open(self._path, "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+        return self
+
+    def __exit__(self, *err):
+        self._file.close()
+        self._file = None
+
+    def record(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def completed(self):
+        """Get identifiers that already have a result. 'errored' results are transient so not included"""
+        return {entry["bnumber"] for entry in read_entries(self._path) if entry["status"] != "errored"}
+
+
+def read_entries(path):
+    if not os.path.exists(path):
+        return
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # partial line from an interrupted run
+                continue
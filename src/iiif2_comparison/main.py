@@ -1,15 +1,57 @@
+import argparse
 import asyncio
 import aiohttp
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import logzero
 import json
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 from logzero import logger
 
+from cache import ResponseCache
+from change_index import ChangeIndex, ContentVersion, content_hash, settings_fingerprint
+from journal import Journal
+from profiler import LEVEL_COLUMNS, Profiler
+from shard import merge_journals, parse_shard, select_shard, shard_journal_path
+from streaming import CountingReader, StreamedManifest
+
 logzero.loglevel(logging.INFO)
 
 ORIGINAL_FORMAT = "https://wellcomelibrary.org/iiif/{bnum}/manifest"
 NEW_FORMAT = "https://iiif-test.wellcomecollection.org/presentation/v2/{bnum}"
 
+# number of b-numbers compared at the same time, and max open connections to any single host
+CONCURRENCY = 1
+LIMIT_PER_HOST = 10
+# number of manifests within a single collection that are fetched + compared at the same time
+EMBEDDED_CONCURRENCY = 5
+
+# original and new clickthrough profiles, differ by more than version but are equivalent
+CLICKTHROUGH_PROFILES = ("http://iiif.io/api/auth/0/login/clickthrough", "http://iiif.io/api/auth/1/clickthrough")
+
+# how long, in seconds, a cached response is used before revalidating. First matching host pattern wins, None = forever
+CACHE_TTLS = [
+    ("wellcomelibrary.org", None),  # originals are frozen
+    ("*", 0),  # always revalidate new, a 304 avoids downloading again
+]
+
+# transient failures are retried with exponential backoff + jitter, starting at BACKOFF seconds
+RETRIES = 3
+BACKOFF = 1
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+TIMEOUT = 60
+# longest Retry-After, in seconds, that will be waited. If asked to wait longer the fetch fails as transient
+MAX_RETRY_AFTER = TIMEOUT
+# max requests per second to a single host, None for no limit
+RATE_LIMIT = None
+# when sampling, items to sample are chosen by a Random seeded with this and the @id of the manifest/collection
+SAMPLE_SEED = 0
+
 rules = {
     "": {
         # metadata + seeAlso massively different
@@ -131,86 +173,261 @@ rules = {
 }
 
 
-class Comparer:
-    _is_authed = False
-    _is_av = False
-    warnings = []
-    failures = []
+class StreamedCanvases(str):
+    """
+    Stands in for the canvases of sequences[0] of a streamed manifest, which are compared as they're read, when the
+    rest of the manifest is compared. Records the number of failures when the comparison reaches canvases. Never
+    equal in a canonical form, so the walk always reaches it, where it compares as equal
+    """
+    __hash__ = str.__hash__
+
+    def __new__(cls, result):
+        return super().__new__(cls, "streamed canvases")
+
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+        self.failure_count = None
+
+    def __eq__(self, other):
+        return False
+
+    def __ne__(self, other):
+        self.failure_count = len(self.result.failures)
+        return False
+
+
+class ComparisonResult:
+    """
+    Outcome of comparing a single original/new pair, including the flags gathered while comparing.
+    All per-comparison state lives here so a single Comparer can be shared by concurrent comparisons.
+    """
+    def __init__(self, identifier=None):
+        self.identifier = identifier
+        self.passed = False
+        self.is_authed = False
+        self.is_av = False
+        self.warnings = []
+        self.failures = []
+        self.timings = {}
+        self.bytes_downloaded = 0
+        # items: {"compared": n, "total": n} for lists that were sampled rather than compared in full
+        self.sampled = {}
+        # (original, new) ContentVersions of manifests compared, recorded in ChangeIndex. Not set for collections as
+        # their result depends on the embedded manifests too
+        self.versions = None
+        self.reused = False
+        # canonical forms of subtrees of (original, new) by id, see Comparer.canonical_subtree. Only valid while the
+        # manifests compared are held, so cleared at the end of each comparison
+        self.canonical_forms = ({}, {})
+
+    def clear_canonical_forms(self):
+        for canonical_forms in self.canonical_forms:
+            canonical_forms.clear()
+
+    def record_sample(self, items, compared, total):
+        sampled = self.sampled.setdefault(items, {"compared": 0, "total": 0})
+        sampled["compared"] += compared
+        sampled["total"] += total
+
+    def reuse(self, entry):
+        """Take outcome from the journal entry of a previous comparison, for manifests that haven't changed since"""
+        self.reused = True
+        self.passed = entry["status"] == "passed"
+        self.failures = list(entry["failures"])
+        self.warnings = list(entry["warnings"])
+        self.sampled = entry.get("sampled", {})
+
+    def sample_summary(self):
+        return ", ".join(f"{s['compared']}/{s['total']} {items}" for items, s in self.sampled.items())
+
+    def as_dict(self, status):
+        entry = {
+            "bnumber": self.identifier,
+            "status": status,
+            "failures": list(dict.fromkeys(self.failures)),
+            "warnings": list(dict.fromkeys(self.warnings)),
+            "timings": {k: round(v, 3) for k, v in self.timings.items()},
+            "bytes": self.bytes_downloaded,
+        }
+        if self.sampled:
+            entry["sampled"] = self.sampled
+        if self.reused:
+            entry["reused"] = True
+        return entry
+
 
-    def __init__(self, loader):
+class Comparer:
+    def __init__(self, loader, embedded_concurrency=EMBEDDED_CONCURRENCY, sample_size=None, sample_seed=SAMPLE_SEED):
+        """
+        :param sample_size: if set, only compare a sample of this many canvases per sequence and manifests per
+            collection, see sample_indices. Everything else, including the number of canvases/manifests, is compared
+            in full. Not supported by start_streamed_comparison
+        :param sample_seed: seed for choosing sample, the same items are compared each run for a given seed
+        """
         self._loader = loader
+        self._embedded_concurrency = embedded_concurrency
+        self._sample_size = sample_size
+        self._sample_seed = sample_seed
 
-    async def start_comparison(self, original, new, identifier=None):
-        self._is_authed = False
-        self._is_av = False
-        self.warnings = []
-        self.failures = []
+    async def start_comparison(self, original, new, identifier=None, result=None):
+        if identifier:
+            logger.info(f"Comparing {identifier}")
+
+        result = result or ComparisonResult(identifier)
+        result.passed = await self.run_comparison(result, original, new, identifier)
+        return result
 
+    async def start_streamed_comparison(self, original, new, identifier=None, result=None):
+        """
+        As start_comparison but for StreamedManifests. Canvases in sequences[0] are compared one at a time as they
+        are parsed, the rest of the manifest is compared once it has been read
+        """
         if identifier:
             logger.info(f"Comparing {identifier}")
 
-        return await self.run_comparison(original, new, identifier)
+        result = result or ComparisonResult(identifier)
+        stream_canvases = all(await gather_or_raise(original.read_envelope(), new.read_envelope()))
+
+        if stream_canvases:
+            canvases_equal, canvas_failures = await self.compare_streamed_canvases(result, original, new)
+
+        # if only 1 has canvases keep them in the envelope so the difference is picked up
+        original_envelope, new_envelope = await gather_or_raise(original.finish(not stream_canvases),
+                                                                new.finish(not stream_canvases))
+        if not stream_canvases:
+            result.passed = await self.run_comparison(result, original_envelope, new_envelope, identifier)
+            return result
+
+        # canvas failures are reported where comparing the whole manifest would reach canvases, and only if it would
+        canvases = StreamedCanvases(result)
+        original_envelope["sequences"][0]["canvases"] = [canvases]
+        new_envelope["sequences"][0]["canvases"] = [StreamedCanvases(result)]
+        result.passed = await self.run_comparison(result, original_envelope, new_envelope, identifier)
+        if canvases.failure_count is not None:
+            result.failures[canvases.failure_count:canvases.failure_count] = canvas_failures
+            result.passed = result.passed and canvases_equal
+        return result
+
+    async def compare_streamed_canvases(self, result, original, new):
+        """
+        Compare canvases of sequences[0] as they are read. If there are more canvases on one side only the
+        difference in length is reported, as dictionary_comparison does.
+        AV and authed flags can only be based on what has been read before canvases. In practice 'mediaSequences'
+        and 'service' precede 'sequences', where they don't canvases are compared without them.
+        :return: (are_equal, failures), failures aren't added to result, see start_streamed_comparison
+        """
+        original_services = self.as_list(original.envelope.get("service", []))
+        new_services = self.as_list(new.envelope.get("service", []))
+        result.is_av = "mediaSequences" in original.envelope
+        result.is_authed = any("authService" in s for s in original_services + new_services)
 
-    async def run_comparison(self, original, new, identifier=None):
-        self._is_av = "mediaSequences" in original
+        are_equal = True
+        failures, result.failures = result.failures, []
+        try:
+            while True:
+                o_canvas, n_canvas = await gather_or_raise(original.next_canvas(), new.next_canvas())
+                if o_canvas is None or n_canvas is None:
+                    break
+
+                are_equal = self.compare_elements(result, "canvases", "sequences", o_canvas, n_canvas, {}) and \
+                    are_equal
+                result.clear_canonical_forms()
+        finally:
+            canvas_failures, result.failures = result.failures, failures
+
+        if o_canvas is not None or n_canvas is not None:
+            await gather_or_raise(original.finish(), new.finish())
+            logger.debug("'sequences'.'canvases' lists of different length: %s - %s",
+                         original.canvas_count, new.canvas_count)
+            return False, ["'sequences'.'canvases' lists of different length"]
+
+        return are_equal, canvas_failures
+
+    async def run_comparison(self, result, original, new, identifier=None):
+        result.is_av = "mediaSequences" in original
 
         original_type = original["@type"]
         if original_type != new["@type"]:
-            self.failures.append("Mismatching type")
+            result.failures.append("Mismatching type")
             return False
 
-        if original_type == "sc:Manifest":
-            logger.debug(f"{identifier} is a manifest..")
-            return self.compare_manifests(original, new)
+        try:
+            if original_type == "sc:Manifest":
+                logger.debug("%s is a manifest..", identifier)
+                return self.compare_manifests(result, original, new)
 
-        elif original_type == "sc:Collection":
-            logger.debug(f"{identifier} is a collection..")
-            return await self.compare_collections(original, new)
+            elif original_type == "sc:Collection":
+                logger.debug("%s is a collection..", identifier)
+                return await self.compare_collections(result, original, new)
+        finally:
+            result.clear_canonical_forms()
 
-    async def compare_collections(self, original, new):
+    async def compare_collections(self, result, original, new):
         # do a "Contains" check for label
         are_equal = True
-        self.compare_label(original.get("label", ""), new.get("label", ""))
-        self.compare_license(original.get("license", None), new.get("license", None))
+        self.compare_label(result, original.get("label", ""), new.get("label", ""))
+        self.compare_license(result, original.get("license", None), new.get("license", None))
 
         # services are finnicky - handle separately
-        are_equal = self.compare_services(original.get("service", {}), new.get("service", {})) and are_equal
+        are_equal = self.compare_services(result, original.get("service", {}), new.get("service", {})) and are_equal
 
         # default comparison
-        are_equal = self.dictionary_comparison(original, new, "") and are_equal
+        are_equal = self.dictionary_comparison(result, original, new, "") and are_equal
 
         # find manifest @id and get data and compare
-        are_equal = await self.compare_embedded_manifests(original.get("manifests", []),
-                                                          new.get("manifests", [])) and are_equal
+        are_equal = await self.compare_embedded_manifests(result, original.get("manifests", []),
+                                                          new.get("manifests", []),
+                                                          original.get("@id", "")) and are_equal
 
         return are_equal
 
-    async def compare_embedded_manifests(self, original_manifests, new_manifests):
+    async def compare_embedded_manifests(self, result, original_manifests, new_manifests, collection_id=""):
         original_len = len(original_manifests)
         new_len = len(new_manifests)
 
         if original_len != new_len:
-            self.failures.append("manifest counts differ")
+            result.failures.append("manifest counts differ")
             return False
 
-        success = True
+        to_compare = range(0, original_len)
+        if self._sample_size and original_len > self._sample_size:
+            to_compare = sample_indices(original_len, self._sample_size, self.get_sample_random(collection_id))
+            result.record_sample("manifests", len(to_compare), original_len)
+
+        semaphore = asyncio.Semaphore(self._embedded_concurrency)
 
-        # iterate through manifests[], fetch each manifest and compare
-        for i in range(0, original_len):
-            logger.debug(f"Comparing manifest {i}")
-            o_id = original_manifests[i].get("@id", None)
-            n_id = new_manifests[i].get("@id", None)
+        async def compare_embedded(i):
+            # each manifest gets its own result so concurrent comparisons don't interleave failures
+            embedded_result = ComparisonResult()
+            async with semaphore:
+                logger.debug("Comparing manifest %s", i)
+                o_id = original_manifests[i].get("@id", None)
+                n_id = new_manifests[i].get("@id", None)
 
-            o_mani = await self._loader.fetch(o_id)
-            n_mani = await self._loader.fetch(n_id)
+                o_mani, n_mani = await gather_or_raise(self._loader.fetch(o_id, embedded_result),
+                                                       self._loader.fetch(n_id, embedded_result))
+                embedded_result.passed = await self.run_comparison(embedded_result, o_mani, n_mani)
+            return embedded_result
 
-            if not await self.run_comparison(o_mani, n_mani):
-                self.failures.append(f"manifest[{i}] are not equal")
+        # fetch each manifest and compare, results are in manifests[] order
+        embedded_results = await gather_or_raise(*(compare_embedded(i) for i in to_compare))
+
+        success = True
+        for i, embedded_result in zip(to_compare, embedded_results):
+            result.is_authed = result.is_authed or embedded_result.is_authed
+            result.bytes_downloaded += embedded_result.bytes_downloaded
+            for items, sampled in embedded_result.sampled.items():
+                result.record_sample(items, sampled["compared"], sampled["total"])
+            result.warnings.extend(embedded_result.warnings)
+            result.failures.extend(embedded_result.failures)
+            if not embedded_result.passed:
+                result.failures.append(f"manifest[{i}] are not equal")
                 success = False
 
         return success
 
-    def compare_manifests(self, original, new):
+    def compare_manifests(self, result, original, new):
         original_services = original.get("service", [])
         new_services = new.get("service", [])
         if isinstance(new_services, dict):
@@ -219,94 +436,130 @@ class Comparer:
             original_services = [original_services]
 
         all_services = original_services + new_services
-        for s in all_services:
-            if "authService" in s:
-                logger.debug("Manifest is authed.. cleaning up original")
-                self._is_authed = True
-                self.clean_auth(original)
+        if any("authService" in s for s in all_services):
+            # duplicated auth services in original are cleaned up as they're compared, see clean_auth
+            logger.debug("Manifest is authed..")
+            result.is_authed = True
 
-        # with open('./original_no_auth.json', 'w') as f:
-        #     json.dump(original, f)
+        if self._sample_size:
+            original, new = self.sample_canvases(result, original, new)
 
         # do a "Contains" check for label
         are_equal = True
-        self.compare_label(original.get("label", ""), new.get("label", ""))
-        self.compare_license(original.get("license", ""), new.get("license", ""))
+        self.compare_label(result, original.get("label", ""), new.get("label", ""))
+        self.compare_license(result, original.get("license", ""), new.get("license", ""))
 
         # services are finnicky - handle separately
-        are_equal = self.compare_services(original_services, new_services) and are_equal
+        are_equal = self.compare_services(result, original_services, new_services) and are_equal
 
         # fall through
-        are_equal = self.dictionary_comparison(original, new, "") and are_equal
+        are_equal = self.dictionary_comparison(result, original, new, "") and are_equal
 
         return are_equal
 
-    def compare_label(self, orig, new):
+    def sample_canvases(self, result, original, new):
+        """
+        Get views of original and new manifests with only a sample of the canvases in each sequence, neither manifest
+        is modified. Sequences with differing numbers of canvases are left whole so the difference is reported
+        """
+        o_sequences = original.get("sequences")
+        n_sequences = new.get("sequences")
+        if not isinstance(o_sequences, list) or not isinstance(n_sequences, list) or \
+                len(o_sequences) != len(n_sequences):
+            return original, new
+
+        sample_random = self.get_sample_random(original.get("@id", ""))
+        o_sampled = []
+        n_sampled = []
+        for o_sequence, n_sequence in zip(o_sequences, n_sequences):
+            o_canvases = o_sequence.get("canvases") if isinstance(o_sequence, dict) else None
+            n_canvases = n_sequence.get("canvases") if isinstance(n_sequence, dict) else None
+            if isinstance(o_canvases, list) and isinstance(n_canvases, list) and \
+                    len(o_canvases) == len(n_canvases) > self._sample_size:
+                indices = sample_indices(len(o_canvases), self._sample_size, sample_random)
+                o_sequence = {**o_sequence, "canvases": [o_canvases[i] for i in indices]}
+                n_sequence = {**n_sequence, "canvases": [n_canvases[i] for i in indices]}
+                result.record_sample("canvases", len(indices), len(o_canvases))
+            o_sampled.append(o_sequence)
+            n_sampled.append(n_sequence)
+
+        if not result.sampled:
+            return original, new
+        return {**original, "sequences": o_sampled}, {**new, "sequences": n_sampled}
+
+    def get_sample_random(self, sampled_id):
+        """Random for choosing sample of items in manifest/collection, the same items are sampled every run"""
+        return random.Random(f"{self._sample_seed}:{sampled_id}")
+
+    def compare_label(self, result, orig, new):
         if not orig:
-            logger.debug(f"'_root_'.'label' origin has no value")
-            self.warnings.append("'_root_'.'label' origin has no value")
+            logger.debug("'_root_'.'label' origin has no value")
+            result.warnings.append("'_root_'.'label' origin has no value")
             return
 
         if orig != new and orig not in new:
-            logger.debug(f"'_root_'.'label' mismatch: {orig} - {new}")
-            self.warnings.append("'_root_'.'label' mismatch")
+            logger.debug("'_root_'.'label' mismatch: %s - %s", orig, new)
+            result.warnings.append("'_root_'.'label' mismatch")
 
-    def compare_license(self, orig, new):
+    def compare_license(self, result, orig, new):
         all_rights = "https://en.wikipedia.org/wiki/All_rights_reserved"
 
         if orig and orig != new:
-            logger.debug(f"'_root_'.'license' origin has value and doesn't match: {orig} - {new}")
-            self.warnings.append("'_root_'.'license' mismatch")
+            logger.debug("'_root_'.'license' origin has value and doesn't match: %s - %s", orig, new)
+            result.warnings.append("'_root_'.'license' mismatch")
         elif new != all_rights:
-            logger.debug(f"'_root_'.'license' origin has no value new isn't ARR: {orig} - {new}")
-            self.warnings.append("'_root_'.'license' mismatch")
+            logger.debug("'_root_'.'license' origin has no value new isn't ARR: %s - %s", orig, new)
+            result.warnings.append("'_root_'.'license' mismatch")
 
-    def clean_auth(self, original):
+    def clean_auth(self, result, original, level):
+        """
+        Get services of dict at level in the original manifest, with duplicated auth services removed if authed.
+        The original isn't modified, so a parsed manifest can be compared more than once
+        :param result: ComparisonResult for current comparison
+        :param original: dict with 'service' key, from original wl.org manifest
+        :param level: level of dict
+        :return: services to compare
+        """
         # auth services are duplicated in the original in:
         # sequences[].canvases[].images[].resource.service[] AND
         # sequences[].canvases[].images[].resource.service["@type": "dctypes:Image"].service[]
-        # this makes it very difficult to deal with so cleaning prior to handling
+        # this makes it very difficult to deal with so cleaning as they're compared
         # the duplicated element is not identical, one has missing elements. Remove the more sparse one.
         # missing elements: confirmLabel, header, failureHeader and failureDescription
+        # for AV the same applies to mediaSequences[].elements[].service and .rendering.service
+        services = original["service"]
+        if not result.is_authed:
+            return services
+        if (level_rules := get_level_rules(level)) is EMPTY_LEVEL_RULES:
+            # levels without rules share their rules, nested image services may still be cleaned
+            cleaning = get_auth_cleaning(level, result.is_av)
+        else:
+            cleaning = level_rules.auth_cleaning[result.is_av]
+        if cleaning is None:
+            return services
 
-        def clean_service_element(services, keep_duplicates=False):
-            # keep non-duplicates in image-service but don't keep in images.services[] element
-            to_keep = []
-            for svc in services:
-                if isinstance(svc, str):
-                    if keep_duplicates and svc not in to_keep:  # a simple string link to a svc "https://dlcs.io/auth/2/clickthrough",
-                        to_keep.append(svc)
-                elif "/image/" in svc["@context"]:  # this is an image service, process it's internal services element
-                    svc["service"] = clean_service_element(svc["service"], True)
-                    to_keep.append(svc)
-                elif "auth" in svc["@id"] and "failureHeader" in svc and keep_duplicates:
+        keep_duplicates, image_services_only = cleaning
+        if image_services_only and "/image/" not in original.get("@context", ""):
+            return services
+        return self.clean_service_element(services, keep_duplicates)
+
+    @staticmethod
+    def clean_service_element(services, keep_duplicates=False):
+        # keep non-duplicates in image-service but don't keep in images.services[] element. Returns new list, image
+        # services are kept as they are - their internal services element is cleaned when it is compared
+        to_keep = []
+        for svc in services:
+            if isinstance(svc, str):
+                if keep_duplicates and svc not in to_keep:  # a simple string link to a svc "https://dlcs.io/auth/2/clickthrough",
                     to_keep.append(svc)
+            elif "/image/" in svc["@context"]:  # this is an image service
+                to_keep.append(svc)
+            elif "auth" in svc["@id"] and "failureHeader" in svc and keep_duplicates:
+                to_keep.append(svc)
 
-            return to_keep
-
-        if not self._is_av:
-            # for each canvas...
-            for c in original["sequences"][0]["canvases"]:
-                # iterate the images...
-                for i in c["images"]:
-                    # get the resource
-                    resource = i["resource"]
-                    # iterate the services
-                    resource["service"] = clean_service_element(resource["service"])
-        else:
-            # for each mediaSequences
-            for ms in original["mediaSequences"]:
-                # iterate the elements...
-                for e in ms["elements"]:
-                    # iterate the renderings..
-                    rendering = e["rendering"]
-                    if isinstance(rendering, dict):
-                        rendering = [rendering]
-                    for r in rendering:
-                        r["service"] = clean_service_element(r["service"], True)
-                    e["service"] = clean_service_element(e["service"], True)
-
-    def compare_services(self, orig, new):
+        return to_keep
+
+    def compare_services(self, result, orig, new):
         # build new dict by key as these can be in funny order
         are_equal = True
 
@@ -337,58 +590,59 @@ class Comparer:
         new_services = get_svc_list(new)
 
         if len(orig_services) != len(new_services):
-            self.warnings.append(f"service are different lengths: {len(orig_services)} - {len(new_services)}")
-            logger.debug(f"service are different lengths: {len(orig_services)} - {len(new_services)}")
+            result.warnings.append(f"service are different lengths: {len(orig_services)} - {len(new_services)}")
+            logger.debug("service are different lengths: %s - %s", len(orig_services), len(new_services))
 
         for k, o in orig_services.items():
             n = new_services.get(k, {})
             if not n:
                 # expect new to always be smaller so not finding a service isn't an issue
-                logger.debug(f"service of type '{k}' not found in new")
+                logger.debug("service of type '%s' not found in new", k)
             else:
-                are_equal = self.dictionary_comparison(o, n, f"service:{k}") and are_equal
+                are_equal = self.dictionary_comparison(result, o, n, f"service:{k}") and are_equal
 
         return are_equal
 
-    def dictionary_comparison(self, orig, new, level, ancestors=None):
+    def dictionary_comparison(self, result, orig, new, level, ancestors=None):
         """
         Iterate through all keys in provided dictionaries, using predefined rules to determine if they are equal
+        :param result: ComparisonResult for current comparison, failures are recorded here
         :param orig: dict of original wl.org item at current level
         :param new: dict of new wl.org item at current level
         :param level: level of dict being interrogated, used to lookup rules and for logging
         :return: boolean value representing whether provided dictionaries are equal
         """
 
-        are_equal = True
-        rules_for_level = rules.get(level, {})
-        ignore = rules_for_level.get("ignore", [])
-        ignore_for_av = rules_for_level.get("ignore_for_av", [])
-        level_for_logs = level if level else '_root_'
+        # identical subtrees, per the rules, don't need walking
+        if self.subtrees_match(result, orig, new, level):
+            return True
 
-        expected_extra_new = rules_for_level.get("extra_new", [])
-        expected_extra_orig = rules_for_level.get("extra_orig", [])
-        size_only = rules_for_level.get("size_only", [])
+        are_equal = True
+        level_rules = get_level_rules(level)
+        level_for_logs = level if level else "_root_"
 
         # check for the existence of
         orig_keys = orig.keys()
         new_keys = new.keys()
         if orig_extra := orig_keys - new_keys:
-            if unexpected_extra := [e for e in orig_extra if e not in expected_extra_orig and orig[e]]:
-                self.failures.append(f"Original '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
-                logger.debug(f"Original '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
+            if unexpected_extra := [e for e in orig_extra if e not in level_rules.extra_orig and
+                                    (self.clean_auth(result, orig, level) if e == "service" else orig[e])]:
+                result.failures.append(f"Original '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
+                logger.debug("Original '%s' has unexpected keys '%s'", level_for_logs, ",".join(unexpected_extra))
                 are_equal = False
 
         if new_extra := new_keys - orig_keys:
-            if unexpected_extra := [e for e in new_extra if e not in expected_extra_new and new[e]]:
-                self.failures.append(f"New '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
-                logger.debug(f"New '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
+            if unexpected_extra := [e for e in new_extra if e not in level_rules.extra_new and new[e]]:
+                result.failures.append(f"New '{level_for_logs}' has unexpected keys '{','.join(unexpected_extra)}'")
+                logger.debug("New '%s' has unexpected keys '%s'", level_for_logs, ",".join(unexpected_extra))
                 are_equal = False
 
-        for key in [k for k in orig_keys if k not in ignore]:
-            if self._is_av and key in ignore_for_av:
+        ignore = level_rules.ignore_with_av if result.is_av else level_rules.ignore
+        for key in orig_keys:
+            if key in ignore:
                 continue
 
-            o = orig.get(key, "")
+            o = self.clean_auth(result, orig, level) if key == "service" else orig[key]
             n = new.get(key, "")
 
             if isinstance(o, dict) and isinstance(n, list):
@@ -397,31 +651,33 @@ class Comparer:
                 n = [n]
             if isinstance(o, list) and isinstance(n, list):
                 # if the 'next' level has an orderBy rule, reorder before compare
-                if order_by := rules.get(self.get_next_level(level, key), {}).get("order_by", ""):
+                if order_by := get_level_rules(self.get_next_level(level, key)).order_by:
                     o = sorted(o, key=lambda item: item[order_by])
                     n = sorted(n, key=lambda item: item[order_by])
 
                 if key == "@context":
-                    o.sort()
-                    n.sort()
+                    o = sorted(o)
+                    n = sorted(n)
 
                 if len(o) != len(n):
-                    self.failures.append(f"'{level_for_logs}'.'{key}' lists of different length")
-                    logger.debug(f"'{level_for_logs}'.'{key}' lists of different length: {len(o)} - {len(n)}")
+                    result.failures.append(f"'{level_for_logs}'.'{key}' lists of different length")
+                    logger.debug("'%s'.'%s' lists of different length: %s - %s", level_for_logs, key, len(o), len(n))
                     are_equal = False
-                elif key not in size_only:  # size check is enough
+                elif key not in level_rules.size_only:  # size check is enough
                     for i in range(0, len(o)):
-                        logger.debug(f"{level}.{key}[{i}]")
-                        are_equal = self.compare_elements(key, level, o[i], n[i],
+                        logger.debug("%s.%s[%s]", level, key, i)
+                        are_equal = self.compare_elements(result, key, level, o[i], n[i],
                                                           ancestors if ancestors else {}) and are_equal
             else:
-                are_equal = self.compare_elements(key, level, o, n, ancestors if ancestors else {}) and are_equal
+                are_equal = self.compare_elements(result, key, level, o, n,
+                                                  ancestors if ancestors else {}) and are_equal
 
         return are_equal
 
-    def compare_elements(self, key, level, orig, new, ancestors):
+    def compare_elements(self, result, key, level, orig, new, ancestors):
         """
         Compare individual elements in manifest, using predefined rules to determine if they are equal
+        :param result: ComparisonResult for current comparison, failures are recorded here
         :param key: key of item in dictionary being interrogated
         :param level: level of dict being interrogated, used to lookup rules and for logging
         :param orig: item for key at current level from original wl.org manifest
@@ -430,50 +686,31 @@ class Comparer:
         :return: boolean value representing whether provided dictionaries are equal
         """
 
-        rules_for_level = rules.get(level, {})
-        level_for_logs = level if level else '_root_'
-        version_insensitive = rules_for_level.get("version_insensitive", [])
-        domain_insensitive = rules_for_level.get("domain_insensitive", [])
-        bnumber_insensitive = rules_for_level.get("bnumber_insensitive", [])
-        dlcs_comparison = rules_for_level.get("dlcs_comparison", [])
-
         if isinstance(orig, dict) and isinstance(new, dict):
             next_level = self.get_next_level(level, key)
             ancestors[next_level] = (new, orig)
-            return self.dictionary_comparison(orig, new, next_level, ancestors)
-        elif isinstance(orig, dict) or isinstance(new, dict):
-            self.failures.append(f"'{level_for_logs}'.'{key}' type mismatch")
-            logger.debug(f"'{level_for_logs}'.'{key}' type mismatch: {type(orig)} - {type(new)}")
+            return self.dictionary_comparison(result, orig, new, next_level, ancestors)
+
+        level_for_logs = level if level else "_root_"
+        if isinstance(orig, dict) or isinstance(new, dict):
+            result.failures.append(f"'{level_for_logs}'.'{key}' type mismatch")
+            logger.debug("'%s'.'%s' type mismatch: %s - %s", level_for_logs, key, type(orig), type(new))
             return False
         else:
             o_v = self.single_or_first(orig)
             n_v = self.single_or_first(new)
-            if key in version_insensitive:
-                if not self.version_insensitive_compare(o_v, n_v):
-                    self.failures.append(f"'{level_for_logs}'.'{key}' failed version-insensitive compare")
-                    logger.debug(f"'{level_for_logs}'.'{key}' failed version-insensitive comparison: '{o_v}' - '{n_v}'")
-                    return False
-            elif key in domain_insensitive:
-                if not self.domain_insensitive_compare(o_v, n_v):
-                    self.failures.append(f"'{level_for_logs}'.'{key}' failed domain-insensitive compare")
-                    logger.debug(f"'{level_for_logs}'.'{key}' failed domain-insensitive comparison: '{o_v}' - '{n_v}'")
-                    return False
-            elif key in bnumber_insensitive:
-                if not self.bnumber_insensitive_compare(o_v, n_v):
-                    self.failures.append(f"'{level_for_logs}'.'{key}' failed bnumber-insensitive compare")
-                    logger.debug(f"'{level_for_logs}'.'{key}' failed bnumber-insensitive comparison: '{o_v}' - '{n_v}'")
-                    return False
-            elif key in dlcs_comparison:
-                if not self.dlcs_comparison(o_v, n_v):
-                    self.failures.append(f"'{level_for_logs}'.'{key}' failed dlcs compare")
-                    logger.debug(f"'{level_for_logs}'.'{key}' failed dlcs: '{o_v}' - '{n_v}'")
+            if strategy := get_level_rules(level).strategies.get(key):
+                name, compare, _ = strategy
+                if not compare(o_v, n_v):
+                    result.failures.append(f"'{level_for_logs}'.'{key}' failed {name} compare")
+                    logger.debug("'%s'.'%s' failed %s comparison: '%s' - '%s'", level_for_logs, key, name, o_v, n_v)
                     return False
             elif o_v != n_v:
                 # old P2 shows largest Width and Height in "sequences-canvases-images-resource"
                 # however, if auth the new will show the largest available
-                if self._is_authed and level == "sequences-canvases-images-resource" and key in ["width",
-                                                                                                 "height"] and o_v > n_v:
-                    # logger.debug(f"'{level_for_logs}'.'{key}' don't match due to auth: '{o_v}' - '{n_v}'")
+                if result.is_authed and level == "sequences-canvases-images-resource" and key in ("width",
+                                                                                                 "height") and o_v > n_v:
+                    # logger.debug("'%s'.'%s' don't match due to auth: '%s' - '%s'", level_for_logs, key, o_v, n_v)
                     pass
                 else:
                     if level == "sequences-canvases-images-resource":
@@ -482,21 +719,121 @@ class Comparer:
                         parent_image = ancestors.get("sequences-canvases-images", ({}, {}))
                         o_image, n_image = parent_image
                         if "thumbnail" not in n_image:
-                            logger.debug(f"'{level_for_logs}'.'{key}' don't match due to no-thumb: '{o_v}' - '{n_v}'")
+                            logger.debug("'%s'.'%s' don't match due to no-thumb: '%s' - '%s'",
+                                         level_for_logs, key, o_v, n_v)
                             return True
 
-                    logger.debug(f"'{level_for_logs}'.'{key}' failed comparison: '{o_v}' - '{n_v}'")
-                    self.failures.append(f"'{level_for_logs}'.'{key}' failed comparison")
+                    logger.debug("'%s'.'%s' failed comparison: '%s' - '%s'", level_for_logs, key, o_v, n_v)
+                    result.failures.append(f"'{level_for_logs}'.'{key}' failed comparison")
                     return False
         return True
 
+    def subtrees_match(self, result, orig, new, level):
+        level_rules = get_level_rules(level)
+        orig_canonical = self.canonical_subtree(result, orig, level_rules, False)
+        return orig_canonical is not None and orig_canonical == self.canonical_subtree(result, new, level_rules, True)
+
+    def canonical_subtree(self, result, value, level_rules, is_new):
+        """
+        Canonical form of dict, according to the rules for its level, such that if original and new canonical forms
+        are equal dictionary_comparison would pass without failures. Ignored keys contribute only their presence,
+        extra_new keys are left out of the new form, size_only lists contribute their length and values with a
+        comparison strategy their canonical value (see COMPARISON_STRATEGIES). Comparing canonical forms is a C-level
+        dict comparison, much cheaper than walking the subtree
+        :param result: ComparisonResult for current comparison, canonical forms are memoised here
+        :param value: dict at level
+        :param level_rules: rules of level dict is at
+        :param is_new: whether value is from the new manifest
+        :return: dict, or None if subtree has no canonical form and needs the full walk
+        """
+        # a dict in a parsed manifest is only ever at 1 level
+        canonical_forms = result.canonical_forms[is_new]
+        if (canonical := canonical_forms.get(id(value), NOT_MEMOISED)) is not NOT_MEMOISED:
+            return canonical
+
+        plan = level_rules.canonical_plan(result.is_av, is_new, result.is_authed)
+        canonical = {}
+        for key, part in value.items():
+            action = plan.get(key)
+            if action is None:
+                # most values are plain scalars, compared as they are
+                if isinstance(part, dict):
+                    part = self.canonical_subtree(result, part, level_rules.next_level_rules(key), is_new)
+                elif isinstance(part, list):
+                    part = self.canonical_value(result, part, level_rules, key, is_new)
+                else:
+                    canonical[key] = part
+                    continue
+                if part is None:
+                    canonical = None
+                    break
+                canonical[key] = part
+            elif action is HAS_STRATEGY:
+                if (part := self.canonical_value(result, part, level_rules, key, is_new)) is None:
+                    canonical = None
+                    break
+                canonical[key] = part
+            elif action is CLEAN_AUTH:
+                part = self.clean_auth(result, value, level_rules.level)
+                if (part := self.canonical_value(result, part, level_rules, key, is_new)) is None:
+                    canonical = None
+                    break
+                canonical[key] = part
+            elif action is PRESENCE_ONLY:
+                canonical[key] = PRESENCE_ONLY
+            elif action is NO_CANONICAL_FORM:
+                canonical = None
+                break
+
+        canonical_forms[id(value)] = canonical
+        return canonical
+
+    def canonical_value(self, result, value, level_rules, key, is_new):
+        """Canonical form of value for key, as compared by dictionary_comparison. None if there isn't one"""
+        if isinstance(value, dict):
+            return self.canonical_subtree(result, value, level_rules.next_level_rules(key), is_new)
+
+        if isinstance(value, list):
+            if key in level_rules.size_only:
+                return "size", len(value)
+
+            try:
+                if order_by := level_rules.next_level_rules(key).order_by:
+                    value = sorted(value, key=lambda item: item[order_by])
+                if key == "@context":
+                    value = sorted(value)
+            except (KeyError, TypeError):
+                return None
+
+            parts = []
+            for item in value:
+                # nested lists are compared by first item only, see single_or_first
+                if isinstance(item, list):
+                    return None
+                if (part := self.canonical_value(result, item, level_rules, key, is_new)) is None:
+                    return None
+                parts.append(part)
+
+            # a single item and a list of just that item compare as equal
+            return parts[0] if len(parts) == 1 else parts
+
+        if strategy := level_rules.strategies.get(key):
+            return strategy[2](value, is_new) if isinstance(value, str) else None
+
+        return value
+
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_next_level(current, next):
         if not next:
             return current
 
         return f"{current}-{next}" if current else next
 
+    @staticmethod
+    def as_list(val):
+        return val if isinstance(val, list) else [val]
+
     @staticmethod
     def single_or_first(val):
         """
@@ -508,7 +845,7 @@ class Comparer:
     @staticmethod
     def version_insensitive_compare(orig, new):
 
-        if orig == "http://iiif.io/api/auth/0/login/clickthrough" and new == "http://iiif.io/api/auth/1/clickthrough":
+        if (orig, new) == CLICKTHROUGH_PROFILES:
             return True
 
         separator = "/" if orig.startswith("http") else " "  # hmmm... yeah
@@ -524,30 +861,65 @@ class Comparer:
         # if here, no diffs so they are the same
         return True
 
+    @staticmethod
+    def version_insensitive_canonical(value, is_new):
+        if value == CLICKTHROUGH_PROFILES[is_new]:
+            # parts of a single profile are never these 2 profiles, so only equal to the other side's equivalent
+            return CLICKTHROUGH_PROFILES
+
+        # comparison allows 1 part to differ, mask the first numeric part as the version. Parts rather than joined
+        # back up, so values with different parts can't end up equal
+        separator = "/" if value.startswith("http") else " "
+        parts = value.split(separator)
+        for i, part in enumerate(parts):
+            if part.isdigit():
+                parts[i] = None
+                break
+        return tuple(parts)
+
     @staticmethod
     def domain_insensitive_compare(orig, new):
         # first 3 will be ["https", "", "domain.com"]
         return orig.split("/")[3:] == new.split("/")[3:]
 
+    @staticmethod
+    def domain_insensitive_canonical(value, is_new):
+        # parts as compared, joining them would make e.g. "abc" and "https://host/" equal
+        return tuple(value.split("/")[3:])
+
     @staticmethod
     def dlcs_comparison(orig, new):
         if "dlcs.io" in new:
             return Comparer.version_insensitive_compare(orig, new)
         else:
-            # https://iiif.wellcomecollection.org/image/b28047345_0032.jp2/info.json
-            # https://iiif-test.wellcomecollection.org/thumbs/b28047345_0032.jp2/info.json
-            expected_space = 5 if new.startswith("https://iiif") else 6
+            return Comparer.version_insensitive_compare(orig, Comparer.dlcs_path(new))
+
+    @staticmethod
+    def dlcs_path(new):
+        # https://iiif.wellcomecollection.org/image/b28047345_0032.jp2/info.json
+        # https://iiif-test.wellcomecollection.org/thumbs/b28047345_0032.jp2/info.json
+        expected_space = 5 if new.startswith("https://iiif") else 6
+
+        slugs = {
+            "thumbs": "thumbs",
+            "image": "iiif-img",
+            "av": "iiif-av",
+            "pdf": "pdf"
+        }
+
+        elements = new.split('/')
+        return f"https://dlcs.io/{slugs.get(elements[3])}/wellcome/{expected_space}/{'/'.join(elements[4:])}"
 
-            slugs = {
-                "thumbs": "thumbs",
-                "image": "iiif-img",
-                "av": "iiif-av",
-                "pdf": "pdf"
-            }
+    @staticmethod
+    def dlcs_canonical(value, is_new):
+        # new is compared as the equivalent dlcs.io path
+        if not is_new or "dlcs.io" in value:
+            return value
+        return Comparer.dlcs_path(value) if value.count("/") >= 3 else None
 
-            elements = new.split('/')
-            dlcs_path = f"https://dlcs.io/{slugs.get(elements[3])}/wellcome/{expected_space}/{'/'.join(elements[4:])}"
-            return Comparer.version_insensitive_compare(orig, dlcs_path)
+    @staticmethod
+    def exact_canonical(value, is_new):
+        return value
 
     @staticmethod
     def bnumber_insensitive_compare(orig, new):
@@ -565,80 +937,772 @@ class Comparer:
         return True
 
 
+class LevelRules:
+    """
+    'rules' for a single level compiled to frozensets, with the comparison to use for each key, so that the
+    comparison walk doesn't rebuild rule lists for every element
+    """
+    __slots__ = ("level", "ignore", "ignore_with_av", "extra_new", "extra_orig", "size_only",
+                 "order_by", "strategies", "auth_cleaning", "_next_level_rules", "_canonical_plans")
+
+    def __init__(self, level, level_rules):
+        def as_set(rule_type):
+            fields = level_rules.get(rule_type, [])
+            return frozenset([fields] if isinstance(fields, str) else fields)
+
+        self.level = level
+        self.ignore = as_set("ignore")
+        self.ignore_with_av = self.ignore | as_set("ignore_for_av")
+        self.extra_new = as_set("extra_new")
+        self.extra_orig = as_set("extra_orig")
+        self.size_only = as_set("size_only")
+        self.order_by = level_rules.get("order_by", "")
+
+        # key: (name, comparison, canonical). First matching rule type wins where a key is in multiple
+        self.strategies = {}
+        for rule_type, name, comparison, canonical in COMPARISON_STRATEGIES:
+            for key in as_set(rule_type):
+                self.strategies.setdefault(key, (name, comparison, canonical))
+
+        # (not AV, AV) see get_auth_cleaning
+        self.auth_cleaning = (None, None) if level is None else \
+            (get_auth_cleaning(level, False), get_auth_cleaning(level, True))
+
+        self._next_level_rules = {}
+        self._canonical_plans = {}
+
+    def next_level_rules(self, key):
+        if self.level is None:
+            # nothing under a level without rules has rules, see compile_rules
+            return self
+        if (next_level_rules := self._next_level_rules.get(key)) is None:
+            next_level_rules = self._next_level_rules[key] = get_level_rules(Comparer.get_next_level(self.level, key))
+        return next_level_rules
+
+    def canonical_plan(self, is_av, is_new, is_authed):
+        """
+        How keys that aren't simply compared contribute to the canonical form of a dict at this level, see
+        Comparer.canonical_subtree. dict of key: LEFT_OUT, PRESENCE_ONLY, NO_CANONICAL_FORM, HAS_STRATEGY or CLEAN_AUTH
+        """
+        # int rather than tuple key, this is called for every dict
+        plan_key = is_av + 2 * is_new + 4 * is_authed
+        if (plan := self._canonical_plans.get(plan_key)) is not None:
+            return plan
+
+        ignore = self.ignore_with_av if is_av else self.ignore
+        may_be_extra, other_may_be_extra = (self.extra_new, self.extra_orig) if is_new else \
+            (self.extra_orig, self.extra_new)
+
+        plan = {}
+        for key in other_may_be_extra - ignore:
+            # left out of the other side's canonical form, but the values are compared if both sides have it
+            plan[key] = NO_CANONICAL_FORM
+        for key in may_be_extra - ignore:
+            # an original key missing from new is compared against "", only new may simply have extra keys
+            plan.setdefault(key, LEFT_OUT if is_new else NO_CANONICAL_FORM)
+        for key in ignore:
+            plan[key] = LEFT_OUT if key in may_be_extra else PRESENCE_ONLY
+        for key in self.strategies:
+            plan.setdefault(key, HAS_STRATEGY)
+        if is_authed and not is_new:
+            if self.level is None:
+                # shared by levels without rules, whether services are cleaned depends on the level
+                plan.setdefault("service", NO_CANONICAL_FORM)
+            elif self.auth_cleaning[is_av]:
+                plan.setdefault("service", CLEAN_AUTH)
+
+        self._canonical_plans[plan_key] = plan
+        return plan
+
+
+# how a key contributes to the canonical form of a dict, see LevelRules.canonical_plan
+LEFT_OUT = "left-out"
+PRESENCE_ONLY = "presence-only"
+NO_CANONICAL_FORM = "no-canonical-form"
+HAS_STRATEGY = "has-strategy"
+CLEAN_AUTH = "clean-auth"
+NOT_MEMOISED = "not-memoised"
+
+
+# comparisons for rule types that compare values, in order of precedence. Each has a function (value, is_new) giving
+# the canonical form of a value for Comparer.canonical_subtree: where the original and new canonical forms are equal
+# the comparison must pass. None where a value has no canonical form
+COMPARISON_STRATEGIES = [
+    ("version_insensitive", "version-insensitive", Comparer.version_insensitive_compare,
+     Comparer.version_insensitive_canonical),
+    ("domain_insensitive", "domain-insensitive", Comparer.domain_insensitive_compare,
+     Comparer.domain_insensitive_canonical),
+    ("bnumber_insensitive", "bnumber-insensitive", Comparer.bnumber_insensitive_compare, Comparer.exact_canonical),
+    ("dlcs_comparison", "dlcs", Comparer.dlcs_comparison, Comparer.dlcs_canonical),
+]
+
+
+# levels whose services are cleaned of auth services duplicated in authed originals, see Comparer.clean_auth.
+# is_av: {level: keep_duplicates}. Image services kept by cleaning have their own services cleaned, keeping duplicates
+AUTH_CLEANED_LEVELS = {
+    False: {"sequences-canvases-images-resource": False},
+    True: {"mediaSequences-elements": True, "mediaSequences-elements-rendering": True},
+}
+
+
+def get_auth_cleaning(level, is_av):
+    """
+    How services of dicts at level are cleaned in authed originals
+    :return: (keep_duplicates, image_services_only) or None if they aren't cleaned
+    """
+    for cleaned_level, keep_duplicates in AUTH_CLEANED_LEVELS[is_av].items():
+        if level == cleaned_level:
+            return keep_duplicates, False
+
+        # image services within cleaned services, however deeply nested
+        nested = level[len(cleaned_level):] if level.startswith(cleaned_level) else ""
+        if nested and nested == "-service" * (len(nested) // len("-service")):
+            return True, True
+    return None
+
+
+def compile_rules(rules_to_compile):
+    """
+    Compile rules to LevelRules by level. Levels above a level with rules are included with empty rules, so that
+    any level that isn't compiled has nothing with rules below it
+    """
+    compiled = {}
+    for level, level_rules in rules_to_compile.items():
+        compiled[level] = LevelRules(level, level_rules)
+        parts = level.split("-")
+        for i in range(1, len(parts)):
+            if (parent := "-".join(parts[:i])) not in rules_to_compile:
+                compiled.setdefault(parent, LevelRules(parent, {}))
+    return compiled
+
+
+COMPILED_RULES = compile_rules(rules)
+
+# rules of every level not in COMPILED_RULES
+EMPTY_LEVEL_RULES = LevelRules(None, {})
+
+
+def get_level_rules(level):
+    """Get compiled rules for level, EMPTY_LEVEL_RULES for levels without rules"""
+    return COMPILED_RULES.get(level, EMPTY_LEVEL_RULES)
+
+
+def sample_indices(count, size, sample_random):
+    """
+    Get indices of a stratified sample of 'size' of 'count' items: the first, the last and 1 random index from each
+    of size - 2 equal width strata of the items between them, so the sample is spread through the list
+    :return: sorted list of indices, all indices if count <= size
+    """
+    if count <= size:
+        return list(range(count))
+    if size < 3:
+        return [0, count - 1][:size]
+
+    middle = count - 2
+    strata = size - 2
+    return [0] + [1 + sample_random.randrange(i * middle // strata, (i + 1) * middle // strata)
+                  for i in range(strata)] + [count - 1]
+
+
+class TransientFetchError(Exception):
+    """Raised when a uri could not be fetched after all retries, e.g. repeated 503s or timeouts"""
+    pass
+
+
+class TransientErrorReader:
+    """
+    Wraps body of a streamed response, raising TransientFetchError if the connection fails or times out part way
+    through, so the b-number is reported as errored and retried on --resume rather than failed
+    """
+
+    def __init__(self, uri, stream, loader):
+        self._uri = uri
+        self._stream = stream
+        self._loader = loader
+
+    async def read(self, n=-1):
+        try:
+            return await self._stream.read(n)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._loader.transient_failures += 1
+            raise TransientFetchError(f"Failed reading {self._uri}. {e!r}") from e
+
+
+class TokenBucket:
+    """Allows an average of 'rate' acquisitions per second, with bursts of up to 'capacity'"""
+
+    def __init__(self, rate, capacity=None):
+        self._rate = rate
+        self._capacity = capacity or max(1, rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class FetchedResponse:
+    """
+    Unparsed response body and validators. If fetched conditionally against the ContentVersion of a previous response,
+    'known', body is None when the server reports it hasn't been modified
+    """
+
+    def __init__(self, body, etag=None, last_modified=None, known=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.known = known
+
+    @functools.cached_property
+    def version(self):
+        if self.body is None:
+            return self.known
+        return ContentVersion(content_hash(self.body), self.etag, self.last_modified)
+
+    def is_unchanged(self):
+        """Whether this is the known version, either not modified or the same content"""
+        return self.known is not None and self.version.content_hash == self.known.content_hash
+
+
 class Loader:
+    def __init__(self, limit_per_host=LIMIT_PER_HOST, cache=None, retries=RETRIES, backoff=BACKOFF,
+                 rate_limit=RATE_LIMIT, original_format=ORIGINAL_FORMAT, new_format=NEW_FORMAT):
+        self._original_format = original_format
+        self._new_format = new_format
+        self._limit_per_host = limit_per_host
+        self._cache = cache
+        self._retries = retries
+        self._backoff = backoff
+        self._rate_limit = rate_limit
+        self._buckets = {}
+
+        self.retried = 0
+        self.transient_failures = 0
+
     async def __aenter__(self):
-        self._session = aiohttp.ClientSession()
+        # original and new are on different hosts so limit is per-host rather than overall
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self._limit_per_host)
+        timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
         return self
 
     async def __aexit__(self, *err):
         await self._session.close()
         self._session = None
 
-    async def fetch_bnumber(self, bnumber, is_original):
-        format = ORIGINAL_FORMAT if is_original else NEW_FORMAT
-        uri = format.replace("{bnum}", bnumber)
+    def get_bnumber_uri(self, bnumber, is_original):
+        format = self._original_format if is_original else self._new_format
+        return format.replace("{bnum}", bnumber)
 
-        return await self.fetch(uri)
+    async def fetch_bnumber(self, bnumber, is_original, result=None):
+        return await self.fetch(self.get_bnumber_uri(bnumber, is_original), result)
 
-    async def fetch(self, uri):
-        async with self._session.get(uri) as response:
-            if 200 <= response.status < 300:
-                response_json = await response.json(content_type=None)  # collections are coming back as text/plain
-                if not response_json:
-                    logger.error(f"{uri} returned nothing")
-                    return {}
-                else:
-                    return response_json
+    async def fetch_bnumber_response(self, bnumber, is_original, result=None, known=None):
+        return await self.fetch_response(self.get_bnumber_uri(bnumber, is_original), result, known)
+
+    async def fetch(self, uri, result=None):
+        """
+        Fetch and parse json from uri
+        :param uri: uri to fetch
+        :param result: optional ComparisonResult to record downloaded bytes against
+        :return: parsed json, or empty dict if not found
+        """
+        return self.parse(uri, await self.fetch_response(uri, result))
 
-            logger.error(f"Failed to get {uri} for comparison. Status {response.status}")
+    async def fetch_response(self, uri, result=None, known=None):
+        """
+        Fetch uri without parsing
+        :param uri: uri to fetch
+        :param result: optional ComparisonResult to record downloaded bytes against
+        :param known: optional ContentVersion of a previous response. If there is no cached response its validators
+            are sent, and the body of the FetchedResponse is None if the server reports it hasn't been modified
+        :return: FetchedResponse, or None if not found
+        """
+        cached = self._cache.get(uri) if self._cache else None
+        if cached and cached.is_fresh:
+            self._cache.hits += 1
+            return FetchedResponse(cached.body, cached.etag, cached.last_modified, known)
+
+        headers = {}
+        validators = cached or known
+        if validators:
+            if validators.etag:
+                headers["If-None-Match"] = validators.etag
+            if validators.last_modified:
+                headers["If-Modified-Since"] = validators.last_modified
+
+        for attempt in range(0, self._retries + 1):
+            if attempt:
+                self.retried += 1
+
+            await self.throttle(uri)
+            retry_after = None
+            try:
+                async with self._session.get(uri, headers=headers) as response:
+                    if response.status not in RETRY_STATUSES:
+                        return await self.read_response(uri, response, cached, result, known)
+
+                    reason = f"Status {response.status}"
+                    retry_after = self.get_retry_after(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = repr(e)
+
+            await self.backoff(uri, attempt, reason, retry_after)
+
+        self.transient_failures += 1
+        raise TransientFetchError(f"Failed to get {uri} after {self._retries + 1} attempts. {reason}")
+
+    @contextlib.asynccontextmanager
+    async def stream(self, uri, result=None):
+        """
+        Open uri for incremental parsing, bypasses cache. Only failures before the body is read are retried
+        :param uri: uri to open
+        :param result: optional ComparisonResult to record downloaded bytes against
+        :return: StreamedManifest, or None if not found
+        """
+        for attempt in range(0, self._retries + 1):
+            if attempt:
+                self.retried += 1
+
+            await self.throttle(uri)
+            retry_after = None
+            try:
+                response = await self._session.get(uri)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = repr(e)
+            else:
+                async with response:
+                    if response.status not in RETRY_STATUSES:
+                        if not 200 <= response.status < 300:
+                            logger.error(f"Failed to get {uri} for comparison. Status {response.status}")
+                            yield None
+                            return
+
+                        def count_bytes(size):
+                            if result:
+                                result.bytes_downloaded += size
+
+                        reader = TransientErrorReader(uri, response.content, self)
+                        yield StreamedManifest(CountingReader(reader, count_bytes))
+                        return
+
+                    reason = f"Status {response.status}"
+                    retry_after = self.get_retry_after(response)
+
+            await self.backoff(uri, attempt, reason, retry_after)
+
+        self.transient_failures += 1
+        raise TransientFetchError(f"Failed to get {uri} after {self._retries + 1} attempts. {reason}")
+
+    def stream_bnumber(self, bnumber, is_original, result=None):
+        return self.stream(self.get_bnumber_uri(bnumber, is_original), result)
+
+    async def backoff(self, uri, attempt, reason, retry_after):
+        if attempt < self._retries:
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                self.transient_failures += 1
+                raise TransientFetchError(f"Failed to get {uri}, asked to retry after {retry_after:.0f}s. {reason}")
+
+            # full jitter, unless the server has told us how long to wait
+            delay = retry_after if retry_after is not None else random.uniform(0, self._backoff * 2 ** attempt)
+            logger.warning(f"Failed to get {uri} ({reason}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def read_response(self, uri, response, cached, result, known=None):
+        if response.status == 304 and cached:
+            self._cache.revalidated += 1
+            self._cache.touch(uri)
+            return FetchedResponse(cached.body, cached.etag, cached.last_modified, known)
+
+        if response.status == 304 and known:
+            return FetchedResponse(None, known=known)
+
+        if 200 <= response.status < 300:
+            body = await response.read()  # collections are coming back as text/plain so parse ourselves
+            if result:
+                result.bytes_downloaded += len(body)
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if body and self._cache:
+                self._cache.misses += 1
+                self._cache.put(uri, body, etag, last_modified)
+            return FetchedResponse(body, etag, last_modified, known)
+
+        logger.error(f"Failed to get {uri} for comparison. Status {response.status}")
+        return None
+
+    def parse(self, uri, response):
+        """
+        Parse json body of FetchedResponse, empty dict if there's no response or nothing in it. Bodies are cached
+        before they're parsed, so any that aren't valid are evicted rather than being used again
+        """
+        if not response:
             return {}
 
+        try:
+            response_json = json.loads(response.body) if response.body else {}
+        except ValueError:
+            self.evict(uri)
+            raise
 
-async def main(bnums):
-    failed = []
-    passed = []
+        if not response_json:
+            logger.error(f"{uri} returned nothing")
+            self.evict(uri)
+            return {}
+        return response_json
 
-    async with Loader() as loader:
-        comparer = Comparer(loader)
-        count = 0
-        for bnumber in await bnum_generator(bnums):
-            count += 1
-            original = await loader.fetch_bnumber(bnumber, True)
-            new = await loader.fetch_bnumber(bnumber, False)
+    def evict(self, uri):
+        if self._cache:
+            self._cache.delete(uri)
 
-            if not original or not new:
-                logger.info(f"{count}**{bnumber} failed to load")
-                failed.append(bnumber)
-                continue
+    async def throttle(self, uri):
+        if not self._rate_limit:
+            return
 
+        host = urlparse(uri).hostname
+        if not (bucket := self._buckets.get(host)):
+            bucket = self._buckets[host] = TokenBucket(self._rate_limit)
+        await bucket.acquire()
+
+    @staticmethod
+    def get_retry_after(response):
+        """Get Retry-After header value in seconds, it can be delta-seconds or http-date"""
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+
+        if retry_after.isdigit():
+            return int(retry_after)
+
+        try:
+            return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+async def gather_or_raise(*aws):
+    """As asyncio.gather but waits for all awaitables to complete before raising first exception, if any"""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            raise r
+    return results
+
+
+async def main(bnums, concurrency=CONCURRENCY, limit_per_host=LIMIT_PER_HOST,
+               embedded_concurrency=EMBEDDED_CONCURRENCY, cache_path=None, retries=RETRIES,
+               rate_limit=RATE_LIMIT, journal_path=None, resume=False, shard=None, shard_by="hash",
+               stream=False, original_format=ORIGINAL_FORMAT, new_format=NEW_FORMAT, sample_size=None,
+               sample_seed=SAMPLE_SEED, index_path=None, profile=False, profile_sort="cumulative"):
+    results = {
+        "passed": [],
+        "failed": [],
+        "errored": [],  # couldn't be compared due to transient errors, worth re-running
+    }
+    sampled = []
+    reused = []
+
+    if stream and sample_size:
+        raise ValueError("sampling isn't supported when streaming")
+    if stream and index_path:
+        raise ValueError("change index isn't supported when streaming")
+
+    cache = ResponseCache(cache_path, CACHE_TTLS) if cache_path else None
+    journal = Journal(journal_path) if journal_path else None
+    index = None
+    if index_path:
+        fingerprint = settings_fingerprint(rules, sample_size, sample_seed, original_format, new_format)
+        index = ChangeIndex(index_path, fingerprint)
+    profiler = Profiler() if profile else None
+
+    completed = journal.completed() if journal and resume else set()
+    if completed:
+        logger.info(f"Resuming, skipping {len(completed)} b-numbers already in {journal_path}")
+
+    async with Loader(limit_per_host, cache, retries, rate_limit=rate_limit, original_format=original_format,
+                      new_format=new_format) as loader:
+        comparer = Comparer(loader, embedded_concurrency, sample_size, sample_seed)
+        if profiler:
+            profiler.instrument(comparer)
+
+        async def compare_bnumber(count, bnumber):
+            result = ComparisonResult(bnumber)
+            status = await fetch_and_compare(count, bnumber, result)
+
+            results[status].append((count, bnumber))
+            if result.sampled:
+                sampled.append(bnumber)
+            if result.reused:
+                reused.append(bnumber)
+
+            entry = result.as_dict(status)
+            if journal:
+                journal.record(entry)
+            if index and result.versions and status != "errored":
+                index.put(bnumber, *result.versions, entry)
+            if profiler:
+                profiler.record_item(bnumber, result)
+
+        async def fetch_and_compare(count, bnumber, result):
             try:
-                if await comparer.start_comparison(original, new, bnumber):
-                    passed.append(bnumber)
-                    logger.info(f"{count}**{bnumber} passed")
-                    if comparer.warnings:
-                        logger.info("\n-".join(set(comparer.warnings)))
+                if stream:
+                    loaded = await stream_and_compare(bnumber, result)
                 else:
-                    failed.append(bnumber)
-                    logger.info(f"{count}**{bnumber} failed")
-                    logger.info("\n-".join(set(comparer.failures)))
+                    loaded = await load_and_compare(bnumber, result)
+            except TransientFetchError as e:
+                logger.info(f"{count}**{bnumber} errored")
+                logger.info(f"\n-{e}")
+                result.failures.append(str(e))
+                return "errored"
             except Exception as e:
-                failed.append(bnumber)
                 logger.info(f"{count}**{bnumber} failed")
                 logger.info(f"\n-{e}")
+                result.failures.append(str(e))
+                return "failed"
+
+            if not loaded:
+                logger.info(f"{count}**{bnumber} failed to load")
+                result.failures.append("failed to load")
+                return "failed"
+
+            if result.reused:
+                logger.info(f"{count}**{bnumber} unchanged, reusing last result")
+            if result.sampled:
+                logger.info(f"{count}**{bnumber} sampled {result.sample_summary()}")
+
+            if result.passed:
+                logger.info(f"{count}**{bnumber} passed")
+                if result.warnings:
+                    logger.info("\n-".join(dict.fromkeys(result.warnings)))
+                return "passed"
+            else:
+                logger.info(f"{count}**{bnumber} failed")
+                logger.info("\n-".join(dict.fromkeys(result.failures)))
+                return "failed"
+
+        async def load_and_compare(bnumber, result):
+            start = time.perf_counter()
+            try:
+                if index:
+                    responses = await fetch_if_changed(bnumber, result)
+                    if result.reused:
+                        return True
+                else:
+                    responses = await gather_or_raise(loader.fetch_bnumber_response(bnumber, True, result),
+                                                      loader.fetch_bnumber_response(bnumber, False, result))
+            finally:
+                result.timings["fetch"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            try:
+                original, new = (loader.parse(loader.get_bnumber_uri(bnumber, is_original), response)
+                                 for is_original, response in zip((True, False), responses))
+            finally:
+                result.timings["parse"] = time.perf_counter() - start
+
+            if not original or not new:
+                return False
+
+            if index and original.get("@type") == "sc:Manifest":
+                result.versions = tuple(response.version for response in responses)
+
+            start = time.perf_counter()
+            try:
+                await comparer.start_comparison(original, new, bnumber, result)
+            finally:
+                result.timings["compare"] = time.perf_counter() - start
+            return True
+
+        async def fetch_if_changed(bnumber, result):
+            """
+            Fetch original and new, reusing the last result from the index if neither has changed since it was
+            compared. New is checked first as originals are frozen, if it has changed original needn't be checked
+            :return: (original, new) FetchedResponses, None if result was reused
+            """
+            indexed = index.get(bnumber)
+            if indexed:
+                new = await loader.fetch_bnumber_response(bnumber, False, result, indexed.new)
+                if new and new.is_unchanged():
+                    original = await loader.fetch_bnumber_response(bnumber, True, result, indexed.original)
+                    if original and original.is_unchanged():
+                        result.versions = (original.version, new.version)
+                        result.reuse(indexed.entry)
+                        return None
+                    if new.body is None:
+                        # original has changed after all, need new to compare against it
+                        new = await loader.fetch_bnumber_response(bnumber, False, result)
+                else:
+                    original = await loader.fetch_bnumber_response(bnumber, True, result)
+            else:
+                original, new = await gather_or_raise(loader.fetch_bnumber_response(bnumber, True, result),
+                                                      loader.fetch_bnumber_response(bnumber, False, result))
+
+            return original, new
 
+        async def stream_and_compare(bnumber, result):
+            # fetching + comparing are interleaved so can only be timed together
+            start = time.perf_counter()
+            try:
+                async with loader.stream_bnumber(bnumber, True, result) as original, \
+                        loader.stream_bnumber(bnumber, False, result) as new:
+                    if not original or not new:
+                        return False
+
+                    await comparer.start_streamed_comparison(original, new, bnumber, result)
+            finally:
+                result.timings["stream"] = time.perf_counter() - start
+            return True
+
+        # workers pull from a shared iterator so only 'concurrency' b-numbers are ever in flight
+        to_compare = enumerate(await bnum_generator(bnums, completed, shard, shard_by), start=1)
+
+        async def worker():
+            for count, bnumber in to_compare:
+                await compare_bnumber(count, bnumber)
+
+        with journal or contextlib.nullcontext():
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    # results arrive in completion order, report in input order
+    log_summary(*([bnumber for _, bnumber in sorted(results[status])] for status in ("passed", "failed", "errored")))
+    if sampled:
+        logger.info(f"{len(sampled)} compared from a sample of at most {sample_size} canvases per sequence and "
+                    f"manifests per collection (seed {sample_seed}), see 'sampled' in journal")
+    if index:
+        fresh = len(results["passed"]) + len(results["failed"]) - len(reused)
+        logger.info(f"index: {len(reused)} results reused as unchanged, {fresh} fresh")
+        index.close()
+    logger.info(f"{loader.retried} retries, {loader.transient_failures} transient failures")
+
+    if cache:
+        logger.info(cache.summary())
+        cache.close()
+
+    if profiler:
+        logger.info("\n".join(profiler.report(profile_sort)))
+
+
+def log_summary(passed, failed, errored):
     logger.info("*****************************")
     logger.info(f"passed ({len(passed)}): {','.join(passed)}")
     logger.info(f"failed ({len(failed)}): {','.join(failed)}")
+    logger.info(f"errored ({len(errored)}): {','.join(errored)}")
 
 
-async def bnum_generator(bnums):
+async def bnum_generator(bnums, exclude=None, shard=None, shard_by="hash"):
     # Allows bnums to be a list or a file location
     # Just because you can, doesn't mean you should
-    return (row.strip("\n") for row in open(bnums)) if isinstance(bnums, str) else bnums
+    rows = (row.strip("\n") for row in open(bnums)) if isinstance(bnums, str) else bnums
+    if shard:
+        rows = select_shard(rows, *shard, shard_by)
+    return (bnum for bnum in rows if bnum not in exclude) if exclude else rows
+
+
+def run_shard(kwargs):
+    asyncio.run(main(**kwargs))
+
+
+def run_sharded(processes, journal_path, **kwargs):
+    """
+    Split bnums into 'processes' shards and compare each in a separate process, each writing to its own journal.
+    Journals are merged into journal_path once all shards are complete. Processes share the cache and index sqlite
+    files, if any: reads are concurrent but writes are one at a time, waiting up to 30s for the lock.
+    """
+    journal_paths = [shard_journal_path(journal_path, i) for i in range(processes)]
+    shard_kwargs = [{**kwargs, "shard": (i, processes), "journal_path": journal_paths[i]} for i in range(processes)]
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        list(executor.map(run_shard, shard_kwargs))
+
+    merge_report(journal_paths, journal_path)
+
+
+def merge_report(journal_paths, output_path=None):
+    by_status = merge_journals(journal_paths, output_path)
+    log_summary(by_status["passed"], by_status["failed"], by_status["errored"])
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare new P2 manifests against wellcomelibrary.org originals")
+    parser.add_argument("bnums", nargs="?", help="file containing 1 b-number per line")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="number of b-numbers to compare at the same time")
+    parser.add_argument("--limit-per-host", type=int, default=LIMIT_PER_HOST,
+                        help="max simultaneous connections to a single host")
+    parser.add_argument("--embedded-concurrency", type=int, default=EMBEDDED_CONCURRENCY,
+                        help="number of manifests in a collection to compare at the same time")
+    parser.add_argument("--cache", help="sqlite file to cache responses in between runs")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="number of times to retry transient failures")
+    parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT,
+                        help="max requests per second to a single host")
+    parser.add_argument("--journal", help="jsonl file to append each result to as soon as it is known")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip b-numbers already in journal. Requires --journal")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse manifests incrementally, comparing canvases one at a time. Doesn't use --cache")
+    parser.add_argument("--sample", type=int, metavar="N",
+                        help="only compare a sample of N canvases per sequence and N manifests per collection: the "
+                             "first, the last and a random spread of the rest. Everything else, including counts, is "
+                             "compared in full. Can't be used with --stream")
+    parser.add_argument("--sample-seed", type=int, default=SAMPLE_SEED,
+                        help="seed for choosing sample, the same items are compared on every run with the same seed")
+    parser.add_argument("--index",
+                        help="sqlite file recording what each b-number was last compared against. B-numbers where "
+                             "neither manifest has changed reuse their last result rather than being compared again. "
+                             "Collections are always compared. Can't be used with --stream")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the comparison per rule level and fetch/parse/compare per b-number, reported at "
+                             "the end of the run. Each process reports separately")
+    parser.add_argument("--profile-sort", choices=LEVEL_COLUMNS, default="cumulative",
+                        help="column to sort rule levels in --profile report by")
+    parser.add_argument("--shard", type=parse_shard, help="only compare shard i/N of bnums, 0 <= i < N")
+    parser.add_argument("--shard-by", choices=["hash", "range"], default="hash",
+                        help="split bnums by hash of b-number or into contiguous ranges")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="split bnums into this many shards and compare each in a separate process. "
+                             "Requires --journal, each process writes to its own journal which are then merged into "
+                             "it. Can't be used with --shard")
+    parser.add_argument("--merge", nargs="+", metavar="JOURNAL",
+                        help="merge journals from a sharded run and report combined results. "
+                             "Journals are merged into --journal, if specified")
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if args.processes > 1 and not args.journal:
+        parser.error("--processes requires --journal")
+    if args.processes > 1 and args.shard:
+        parser.error("--shard can't be used with --processes")
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+    if args.sample and args.stream:
+        parser.error("--sample can't be used with --stream")
+    if args.index and args.stream:
+        parser.error("--index can't be used with --stream")
+
     bnums = ['b28685520', 'b15701360', 'b20461549', 'b28644475', 'b28545187', 'b20442324']
     av_bd = ['b32496485', 'b17442783', 'b16756654', 'b29236927', 'b21320962']
     file = r"C:\repos\wellcomecollection\iiif-builder\src\Wellcome.Dds\CatalogueClient\examples.txt"
-    asyncio.run(main(bnums))
+
+    if args.merge:
+        merge_report(args.merge, args.journal)
+    elif args.processes > 1:
+        run_sharded(args.processes, args.journal, bnums=args.bnums or bnums, concurrency=args.concurrency,
+                    limit_per_host=args.limit_per_host, embedded_concurrency=args.embedded_concurrency,
+                    cache_path=args.cache, retries=args.retries, rate_limit=args.rate_limit,
+                    resume=args.resume, shard_by=args.shard_by, stream=args.stream, sample_size=args.sample,
+                    sample_seed=args.sample_seed, index_path=args.index, profile=args.profile,
+                    profile_sort=args.profile_sort)
+    else:
+        asyncio.run(main(args.bnums or bnums, args.concurrency, args.limit_per_host, args.embedded_concurrency,
+                         args.cache, args.retries, args.rate_limit, args.journal, args.resume, args.shard,
+                         args.shard_by, args.stream, sample_size=args.sample, sample_seed=args.sample_seed,
+                         index_path=args.index, profile=args.profile, profile_sort=args.profile_sort))
@@ -0,0 +1,93 @@
+import time
+
+LEVEL_COLUMNS = ("calls", "elements", "matched", "cumulative", "own")
+
+
+class LevelStats:
+    __slots__ = LEVEL_COLUMNS
+
+    def __init__(self):
+        self.calls = 0
+        self.elements = 0
+        self.matched = 0
+        self.cumulative = 0.0
+        self.own = 0.0
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of a run. Per rule level: number of dictionary_comparison calls, elements (keys of the
+    original dicts) compared, calls where subtrees matched without walking, and cumulative time + own time, excluding
+    nested levels. Per b-number: timings and bytes downloaded.
+    Comparer methods are only wrapped by instrument(), so there's no overhead when not profiling.
+    """
+
+    def __init__(self):
+        self.levels = {}
+        self.items = {}
+
+    def instrument(self, comparer):
+        """Wrap comparer's dictionary_comparison + subtrees_match, recursive calls go through the wrapped versions"""
+        dictionary_comparison = comparer.dictionary_comparison
+        subtrees_match = comparer.subtrees_match
+        levels = self.levels
+        # time spent in nested levels, per dictionary_comparison call in progress. Comparing dicts never awaits so
+        # calls for concurrent comparisons can't interleave
+        nested = [0.0]
+
+        def profiled_dictionary_comparison(result, orig, new, level, ancestors=None):
+            if (stats := levels.get(level)) is None:
+                stats = levels[level] = LevelStats()
+
+            nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                return dictionary_comparison(result, orig, new, level, ancestors)
+            finally:
+                elapsed = time.perf_counter() - start
+                in_nested = nested.pop()
+                nested[-1] += elapsed
+                stats.calls += 1
+                stats.elements += len(orig)
+                stats.cumulative += elapsed
+                stats.own += elapsed - in_nested
+
+        def profiled_subtrees_match(result, orig, new, level):
+            matched = subtrees_match(result, orig, new, level)
+            if matched:
+                levels[level].matched += 1
+            return matched
+
+        comparer.dictionary_comparison = profiled_dictionary_comparison
+        comparer.subtrees_match = profiled_subtrees_match
+
+    def record_item(self, identifier, result):
+        """Record timings + bytes downloaded for ComparisonResult of b-number"""
+        self.items[identifier] = {**result.timings, "bytes": result.bytes_downloaded}
+
+    def report(self, sort_by="cumulative", top=20):
+        """
+        Get report lines: totals, levels sorted by sort_by (one of LEVEL_COLUMNS) and the 'top' slowest b-numbers
+        """
+        lines = []
+        stages = list(dict.fromkeys(stage for item in self.items.values() for stage in item if stage != "bytes"))
+        totals = ", ".join(f"{stage} {sum(item.get(stage, 0) for item in self.items.values()):.2f}s"
+                           for stage in stages)
+        total_bytes = sum(item["bytes"] for item in self.items.values())
+        lines.append(f"profile: {len(self.items)} b-numbers, {totals}, {total_bytes / 1024 / 1024:.1f}MB downloaded")
+
+        width = max((len(level) for level in self.levels), default=6) + 2
+        lines.append(f"{'level':<{width}}{'calls':>10}{'elements':>12}{'matched':>10}{'cumulative':>12}{'own':>10}")
+        for level, stats in sorted(self.levels.items(), key=lambda item: getattr(item[1], sort_by), reverse=True):
+            lines.append(f"{level or '_root_':<{width}}{stats.calls:>10}{stats.elements:>12}{stats.matched:>10}"
+                         f"{stats.cumulative:>12.4f}{stats.own:>10.4f}")
+
+        slowest = sorted(self.items.items(), key=lambda item: sum(item[1].get(stage, 0) for stage in stages),
+                         reverse=True)[:top]
+        if slowest:
+            lines.append(f"slowest {len(slowest)} b-numbers")
+            lines.append(f"{'bnumber':<14}" + "".join(f"{stage:>10}" for stage in stages) + f"{'bytes':>12}")
+            for identifier, item in slowest:
+                lines.append(f"{identifier:<14}" + "".join(f"{item.get(stage, 0):>10.4f}" for stage in stages) +
+                             f"{item['bytes']:>12}")
+        return lines
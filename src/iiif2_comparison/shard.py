@@ -0,0 +1,60 @@
+import json
+import os
+import zlib
+
+from journal import read_entries
+
+
+def parse_shard(value):
+    """Parse 'i/N' into (i, N) tuple, where i is 0-based index of shard and N the total number of shards"""
+    index, count = (int(part) for part in value.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard '{value}', expected i/N with 0 <= i < N")
+    return index, count
+
+
+def select_shard(bnums, index, count, by="hash"):
+    """
+    Get the b-numbers that belong to shard 'index' of 'count'.
+    'hash' is stable regardless of input order, 'range' splits input into contiguous blocks
+    """
+    if by == "hash":
+        return (bnum for bnum in bnums if zlib.crc32(bnum.encode()) % count == index)
+
+    bnums = list(bnums)
+    size = -(-len(bnums) // count)  # ceiling division so the last shard is the smallest
+    return iter(bnums[index * size:(index + 1) * size])
+
+
+def shard_journal_path(journal_path, index):
+    """results.jsonl -> results.0.jsonl"""
+    root, ext = os.path.splitext(journal_path)
+    return f"{root}.{index}{ext}"
+
+
+def merge_journals(journal_paths, output_path=None):
+    """
+    Combine multiple journals, where a b-number appears multiple times the latest entry wins
+    :param journal_paths: journals to merge
+    :param output_path: optional location to write combined journal to. If it already exists it is merged into,
+        its entries are kept unless a b-number appears in journal_paths
+    :return: dict of status: [bnumbers]
+    """
+    entries = {}
+    for path in ([output_path] if output_path else []) + list(journal_paths):
+        for entry in read_entries(path):
+            entries[entry["bnumber"]] = entry
+
+    if output_path:
+        # replaced in one go so the existing journal isn't lost if writing fails part way
+        partial_path = f"{output_path}.partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(partial_path, output_path)
+
+    by_status = {"passed": [], "failed": [], "errored": []}
+    for bnumber, entry in entries.items():
+        by_status.setdefault(entry["status"], []).append(bnumber)
+    return by_status
+
@@ -0,0 +1,108 @@
+import ijson
+
+CANVASES = "sequences.item.canvases"
+CANVAS = "sequences.item.canvases.item"
+
+
+class CountingReader:
+    """Wraps an async stream, e.g. aiohttp StreamReader, counting bytes read"""
+
+    def __init__(self, stream, on_read=None):
+        self._stream = stream
+        self._on_read = on_read
+
+    async def read(self, n=-1):
+        data = await self._stream.read(n)
+        if self._on_read:
+            self._on_read(len(data))
+        return data
+
+
+class StreamedManifest:
+    """
+    Manifest parsed incrementally from a stream. Canvases in sequences[0] are returned one at a time by
+    next_canvas() and are never held in memory together. Everything else is built up in 'envelope', where
+    sequences[0].canvases is an empty list.
+
+    Usage is read_envelope(), then next_canvas() until it returns None, then finish() to complete envelope.
+    """
+
+    def __init__(self, stream):
+        self._events = ijson.parse_async(stream, use_float=True).__aiter__()
+        self._builder = ijson.ObjectBuilder()
+        self._sequence_index = -1
+        self._in_canvases = False
+        self.canvas_count = 0
+
+    @property
+    def envelope(self):
+        return self._builder.value
+
+    async def _next_event(self):
+        try:
+            return await self._events.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def read_envelope(self):
+        """
+        Read until the start of sequences[0].canvases, or end of document.
+        :return: True if canvases are ready to be read, else False
+        """
+        while event := await self._next_event():
+            prefix, event_type, value = event
+            self._builder.event(event_type, value)
+
+            if prefix == "sequences" and event_type == "start_array":
+                self._sequence_index = -1
+            elif prefix == "sequences.item" and event_type == "start_map":
+                self._sequence_index += 1
+            elif prefix == CANVASES and event_type == "start_array" and self._sequence_index == 0:
+                self._in_canvases = True
+                return True
+
+        return False
+
+    async def next_canvas(self):
+        """Get next canvas from sequences[0], or None if there are no more"""
+        if not self._in_canvases:
+            return None
+
+        canvas_builder = None
+        depth = 0
+        while event := await self._next_event():
+            prefix, event_type, value = event
+            if depth == 0 and prefix == CANVASES and event_type == "end_array":
+                self._builder.event(event_type, value)
+                self._in_canvases = False
+                return None
+
+            if canvas_builder is None:
+                canvas_builder = ijson.ObjectBuilder()
+            canvas_builder.event(event_type, value)
+
+            if event_type in ("start_map", "start_array"):
+                depth += 1
+            elif event_type in ("end_map", "end_array"):
+                depth -= 1
+
+            if depth == 0:
+                self.canvas_count += 1
+                return canvas_builder.value
+
+        return None
+
+    async def finish(self, keep_canvases=False):
+        """
+        Read remainder of document into envelope
+        :param keep_canvases: if True, unread canvases are added to envelope. Otherwise they are skipped
+        """
+        if not keep_canvases:
+            while await self.next_canvas() is not None:
+                pass
+
+        while event := await self._next_event():
+            _, event_type, value = event
+            self._builder.event(event_type, value)
+
+        return self.envelope
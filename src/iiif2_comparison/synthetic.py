@@ -0,0 +1,359 @@
+"""
+Synthetic IIIF v2 manifest + collection pairs, in the shape of wellcomelibrary.org originals and their new
+equivalents, for benchmarking the comparison engine offline. Pairs are equal unless differences are injected.
+StandInServer serves a corpus over http in place of the real hosts.
+"""
+import asyncio
+import hashlib
+import json
+import random
+
+from aiohttp import web
+
+ORIGINAL_HOST = "https://wellcomelibrary.org"
+NEW_HOST = "https://iiif.wellcomecollection.org"
+
+AUTH_PROFILES = {
+    # original: new
+    "clickthrough": ("http://iiif.io/api/auth/0/login/clickthrough", "http://iiif.io/api/auth/1/clickthrough"),
+    "token": ("http://iiif.io/api/auth/0/token", "http://iiif.io/api/auth/1/token"),
+}
+
+
+def image_manifest(bnumber, canvases, is_new, authed=False):
+    """Get sc:Manifest with 'canvases' image canvases"""
+    def image_service(i):
+        service = {
+            "@context": "http://iiif.io/api/image/2/context.json",
+            "@id": dlcs_uri(is_new, "image", f"{bnumber}_{i:04}.jp2"),
+            "profile": "http://iiif.io/api/image/2/level1.json",
+        }
+        if is_new:
+            service.update({"width": 2048, "height": 3072, "protocol": "http://iiif.io/api/image"})
+        if authed:
+            service["service"] = [auth_service(is_new), auth_service_id()]
+        return service
+
+    def canvas(i):
+        resource_service = image_service(i)
+        if authed and not is_new:
+            # original duplicates auth services, with 1 copy missing fields. See Comparer.clean_auth
+            sparse = auth_service(False)
+            del sparse["failureHeader"]
+            resource_service = [resource_service, sparse]
+
+        return {
+            "@id": f"{manifest_id(bnumber, is_new)}/canvases/c{i}",
+            "@type": "sc:Canvas",
+            "label": f" - {i + 1}",
+            "thumbnail": {
+                "@id": dlcs_uri(is_new, "thumbs", f"{bnumber}_{i:04}.jp2/full/72,100/0/default.jpg"),
+                "@type": "dctypes:Image",
+                "service": {
+                    "@context": "http://iiif.io/api/image/2/context.json",
+                    "@id": dlcs_uri(is_new, "thumbs", f"{bnumber}_{i:04}.jp2"),
+                    "profile": "http://iiif.io/api/image/2/level0.json",
+                },
+            },
+            "height": 3072,
+            "width": 2048,
+            "images": [{
+                "@id": f"{manifest_id(bnumber, is_new)}/imageanno/{i}",
+                "@type": "oa:Annotation",
+                "motivation": "sc:painting",
+                "resource": {
+                    "@id": dlcs_uri(is_new, "image", f"{bnumber}_{i:04}.jp2/full/!1024,1024/0/default.jpg"),
+                    "@type": "dctypes:Image",
+                    "format": "image/jpeg",
+                    "height": 1024,
+                    "width": 683,
+                    "service": resource_service,
+                },
+                "on": f"{manifest_id(bnumber, is_new)}/canvases/c{i}",
+            }],
+        }
+
+    manifest = manifest_envelope(bnumber, is_new, authed)
+    manifest["sequences"] = [{
+        "@id": f"{manifest_id(bnumber, is_new)}/sequences/s0",
+        "@type": "sc:Sequence",
+        "label": "Sequence s0",
+        "canvases": [canvas(i) for i in range(canvases)],
+    }]
+    manifest["structures"] = [{
+        "@id": f"{manifest_id(bnumber, is_new)}/ranges/r0",
+        "@type": "sc:Range",
+        "label": "Title Page",
+        "canvases": [f"{manifest_id(bnumber, is_new)}/canvases/c{i}" for i in range(min(canvases, 3))],
+    }]
+    return manifest
+
+
+def av_manifest(bnumber, elements, is_new, authed=False):
+    """Get sc:Manifest with 'elements' mediaSequences elements and a placeholder canvas"""
+    def element(i):
+        file = f"{bnumber}_{i:04}.mp4"
+        el = {
+            "@id": dlcs_uri(is_new, "av", file),
+            "@type": "dctypes:Sound",
+            "format": "audio/mp4",
+            "label": f"{bnumber} part {i + 1}",
+            "rendering": {"@id": dlcs_uri(is_new, "av", file), "format": "audio/mp4"},
+            "resources": [{
+                "@id": f"{manifest_id(bnumber, is_new)}/transcript/{i}",
+                "@type": "oa:Annotation",
+                "on": dlcs_uri(is_new, "av", file),
+                "resource": {"@id": "transcript", "@type": "dctypes:Text", "format": "text/plain"},
+            }],
+        }
+        if is_new:
+            el["metadata"] = [{"label": "length", "value": "3:21"}]
+        if authed:
+            el["service"] = [auth_service(is_new), auth_service_id()]
+            if not is_new:
+                # original duplicates auth services, with 1 copy missing fields. See Comparer.clean_auth
+                sparse = auth_service(False)
+                del sparse["failureHeader"]
+                el["service"].append(sparse)
+            el["rendering"]["service"] = [auth_service(is_new)]
+        return el
+
+    manifest = manifest_envelope(bnumber, is_new, authed)
+    manifest["mediaSequences"] = [{
+        "@id": f"{ORIGINAL_HOST if not is_new else NEW_HOST}/iiif/{bnumber}/xsequence/s0",
+        "@type": "ixif:MediaSequence",
+        "label": "XSequence 0",
+        "elements": [element(i) for i in range(elements)],
+    }]
+    manifest["sequences"] = [{
+        "@id": f"{manifest_id(bnumber, is_new)}/sequences/s0",
+        "@type": "sc:Sequence",
+        "label": "Unknown sequence",
+        "canvases": [{
+            "@id": f"{manifest_id(bnumber, is_new)}/canvas/c0",
+            "@type": "sc:Canvas",
+            "label": "Placeholder image",
+            "thumbnail": f"{ORIGINAL_HOST if not is_new else NEW_HOST}/placeholder.jpg",
+            "height": 600,
+            "width": 600,
+            "images": [],
+        }],
+    }]
+    return manifest
+
+
+def collection(bnumber, child_uris, is_new):
+    """Get sc:Collection with embedded manifests at provided uris"""
+    return {
+        "@context": "http://iiif.io/api/presentation/2/context.json",
+        "@id": manifest_id(bnumber, is_new),
+        "@type": "sc:Collection",
+        "label": f"Collection {bnumber}",
+        "license": "https://en.wikipedia.org/wiki/All_rights_reserved",
+        "manifests": [
+            {"@id": uri, "@type": "sc:Manifest", "label": f"Volume {i + 1}"} for i, uri in enumerate(child_uris)
+        ],
+    }
+
+
+def manifest_envelope(bnumber, is_new, authed):
+    services = [{
+        "@context": "http://iiif.io/api/search/0/context.json",
+        "@id": f"{ORIGINAL_HOST if not is_new else NEW_HOST}/annoservices/search/{bnumber}",
+        "profile": "http://iiif.io/api/search/0/search",
+        "label": "Search within this manifest",
+        "service": {
+            "@id": f"{ORIGINAL_HOST if not is_new else NEW_HOST}/annoservices/autocomplete/{bnumber}",
+            "profile": "http://iiif.io/api/search/0/autocomplete",
+            "label": "Get suggested words in this manifest",
+        },
+    }]
+    if authed:
+        services.append({
+            "@context": "http://wellcomelibrary.org/ld/iiif-ext/0/context.json",
+            "@id": f"{ORIGINAL_HOST if not is_new else NEW_HOST}/iiif/{bnumber}-0/access-control-hints-service",
+            "profile": "http://wellcomelibrary.org/ld/iiif-ext/0/accessControlHints",
+            "accessHint": "clickthrough",
+            "authService": auth_service_id(),
+        })
+
+    return {
+        "@context": "http://iiif.io/api/presentation/2/context.json",
+        "@id": manifest_id(bnumber, is_new),
+        "@type": "sc:Manifest",
+        "label": f"Synthetic work {bnumber}",
+        "metadata": [{"label": "Reference", "value": bnumber}],
+        "license": "https://en.wikipedia.org/wiki/All_rights_reserved",
+        "logo": "https://wellcomelibrary.org/assets/img/squarelogo64.png",
+        "related": {"@id": f"https://wellcomecollection.org/works/{bnumber}", "format": "text/html"},
+        "service": services,
+    }
+
+
+def auth_service(is_new):
+    clickthrough, token = (profiles[1 if is_new else 0] for profiles in AUTH_PROFILES.values())
+    return {
+        "@context": "http://iiif.io/api/auth/0/context.json",
+        "@id": auth_service_id(),
+        "profile": clickthrough,
+        "label": "Archival material less than 100 years old",
+        "header": "Content advisory",
+        "confirmLabel": "Accept Terms and Open",
+        "failureHeader": "Terms not accepted",
+        "failureDescription": "You must accept the terms to view the content",
+        "service": [{"@id": "https://iiif.wellcomecollection.org/auth/token", "profile": token}],
+    }
+
+
+def auth_service_id():
+    return "https://iiif.wellcomecollection.org/auth/clickthrough"
+
+
+def manifest_id(bnumber, is_new):
+    return f"{NEW_HOST}/presentation/v2/{bnumber}" if is_new else f"{ORIGINAL_HOST}/iiif/{bnumber}/manifest"
+
+
+def dlcs_uri(is_new, resource_type, path):
+    """Original uses dlcs.io, new uses iiif.wc.org equivalent. See Comparer.dlcs_comparison"""
+    if is_new:
+        return f"{NEW_HOST}/{resource_type}/{path}"
+
+    slug = {"thumbs": "thumbs", "image": "iiif-img", "av": "iiif-av"}[resource_type]
+    return f"https://dlcs.io/{slug}/wellcome/5/{path}"
+
+
+def inject_difference(manifest, rnd):
+    """Alter new manifest in a way that will cause comparison to fail"""
+    canvases = manifest["sequences"][0]["canvases"]
+    canvas = rnd.choice(canvases)
+    difference = rnd.choice(["label", "height", "extra_key", "missing_canvas"])
+    if difference == "label":
+        canvas["label"] += " (altered)"
+    elif difference == "height":
+        canvas["height"] += 1
+    elif difference == "extra_key":
+        canvas["unexpected"] = "value"
+    elif difference == "missing_canvas" and len(canvases) > 1:
+        canvases.remove(canvas)
+    else:
+        canvas["label"] += " (altered)"
+
+
+def alter_randomly(manifest, rnd):
+    """Make a random small change anywhere in manifest, which may or may not cause comparison to fail"""
+    def keys(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield value, key
+                yield from keys(item)
+        elif isinstance(value, list):
+            for item in value:
+                yield from keys(item)
+
+    parent, key = rnd.choice(list(keys(manifest)))
+    value = parent[key]
+    if isinstance(value, str):
+        parent[key] = rnd.choice([value + "x", value.replace("1", "2"), value.split("/")[0], "", "abc",
+                                  "https://host/"])
+    elif isinstance(value, int):
+        parent[key] = value + 1
+    elif isinstance(value, list) and value and rnd.random() < 0.5:
+        value.pop()
+    elif rnd.random() < 0.7:
+        del parent[key]
+    else:
+        parent[f"{key}extra"] = "value"
+
+
+def make_corpus(items, canvases=100, av_ratio=0.1, authed_ratio=0.2, collection_ratio=0.05, collection_size=5,
+                failure_ratio=0.1, seed=1, base_uri="http://localhost:8080"):
+    """
+    Generate a corpus of original/new pairs
+    :param items: number of top-level items to generate
+    :param canvases: number of canvases per image manifest, or (min, max) tuple
+    :param av_ratio: proportion of items that are AV, using mediaSequences
+    :param authed_ratio: proportion of items with auth services
+    :param collection_ratio: proportion of items that are collections of 'collection_size' manifests
+    :param collection_size: number of manifests in each collection
+    :param failure_ratio: proportion of manifests with an injected difference
+    :param seed: random seed, the same arguments always produce the same corpus
+    :param base_uri: where corpus will be served, used for @id of manifests embedded in collections
+    :return: tuple of (top-level identifiers, {identifier: {"original": manifest, "new": manifest}})
+    """
+    rnd = random.Random(seed)
+    identifiers = []
+    documents = {}
+
+    def add_manifest(identifier):
+        is_authed = rnd.random() < authed_ratio
+        canvas_count = rnd.randint(*canvases) if isinstance(canvases, tuple) else canvases
+        if rnd.random() < av_ratio:
+            pair = {"original": av_manifest(identifier, max(1, canvas_count // 50), False, is_authed),
+                    "new": av_manifest(identifier, max(1, canvas_count // 50), True, is_authed)}
+        else:
+            pair = {"original": image_manifest(identifier, canvas_count, False, is_authed),
+                    "new": image_manifest(identifier, canvas_count, True, is_authed)}
+
+        if rnd.random() < failure_ratio:
+            inject_difference(pair["new"], rnd)
+        documents[identifier] = pair
+
+    for i in range(items):
+        identifier = f"b{i:08}"
+        identifiers.append(identifier)
+        if rnd.random() < collection_ratio:
+            children = [f"{identifier}_{c:04}" for c in range(collection_size)]
+            for child in children:
+                add_manifest(child)
+            documents[identifier] = {
+                side: collection(identifier, [f"{base_uri}/{side}/{child}" for child in children], side == "new")
+                for side in ("original", "new")
+            }
+        else:
+            add_manifest(identifier)
+
+    return identifiers, documents
+
+
+class StandInServer:
+    """
+    Serves a corpus from make_corpus at /original/{identifier} and /new/{identifier}, with ETags.
+    e.g. main(..., original_format="http://127.0.0.1:8080/original/{bnum}")
+    """
+
+    def __init__(self, documents, host="127.0.0.1", port=8080):
+        self._host = host
+        self._port = port
+        self._runner = None
+        self._bodies = {}
+        for identifier, pair in documents.items():
+            for side, document in pair.items():
+                body = json.dumps(document).encode()
+                self._bodies[(side, identifier)] = (body, f'"{hashlib.md5(body).hexdigest()}"')
+
+    async def handle(self, request):
+        document = self._bodies.get((request.match_info["side"], request.match_info["identifier"]))
+        if not document:
+            return web.Response(status=404)
+
+        body, etag = document
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{side}/{identifier}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
@@ -0,0 +1,92 @@
+"""
+Comparisons with the compiled rules (see compile_rules) give the verdicts and failures comparing with the rules dict
+did: passing, failing, authed and AV pairs, and levels without rules.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import logging
+import os
+import sys
+import unittest
+from unittest import mock
+
+import logzero
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from synthetic import av_manifest, image_manifest  # noqa: E402
+
+logzero.loglevel(logging.WARNING)
+
+
+def compare(original, new):
+    result = asyncio.run(main.Comparer(None).start_comparison(original, new))
+    return result.passed, result.failures
+
+
+class CompiledRulesTest(unittest.TestCase):
+    def test_passing(self):
+        for make_manifest in (image_manifest, av_manifest):
+            for authed in (False, True):
+                with self.subTest(manifest=make_manifest.__name__, authed=authed):
+                    original = make_manifest("b10000001", 3, is_new=False, authed=authed)
+                    new = make_manifest("b10000001", 3, is_new=True, authed=authed)
+                    self.assertEqual(compare(original, new), (True, []))
+
+    def test_failing(self):
+        original = image_manifest("b10000001", 3, is_new=False)
+        new = image_manifest("b10000001", 3, is_new=True)
+        canvases = new["sequences"][0]["canvases"]
+        canvases[0]["unexpected"] = "value"
+        canvases[1]["label"] += " (altered)"
+        canvases[2]["height"] += 1
+
+        self.assertEqual(compare(original, new), (False, [
+            "New 'sequences-canvases' has unexpected keys 'unexpected'",
+            "'sequences-canvases'.'label' failed comparison",
+            "'sequences-canvases'.'height' failed comparison",
+        ]))
+
+    def test_authed_failing(self):
+        original = image_manifest("b10000001", 3, is_new=False, authed=True)
+        new = image_manifest("b10000001", 3, is_new=True, authed=True)
+        new["sequences"][0]["canvases"][1]["images"][0]["resource"]["service"]["service"][0]["label"] = "altered"
+
+        self.assertEqual(compare(original, new), (False, [
+            "'sequences-canvases-images-resource-service-service'.'label' failed comparison",
+        ]))
+
+    def test_av_authed_failing(self):
+        original = av_manifest("b10000001", 3, is_new=False, authed=True)
+        new = av_manifest("b10000001", 3, is_new=True, authed=True)
+        elements = new["mediaSequences"][0]["elements"]
+        elements[0]["@id"] += "x"  # dlcs comparison allows 1 part to differ
+        elements[1]["format"] = "altered"
+
+        self.assertEqual(compare(original, new), (False, ["'mediaSequences-elements'.'format' failed comparison"]))
+
+    def test_level_without_rules(self):
+        original = image_manifest("b10000001", 2, is_new=False)
+        new = image_manifest("b10000001", 2, is_new=True)
+        original["sequences"][0]["canvases"][0]["extra"] = {"nested": {"value": 1}}
+        new["sequences"][0]["canvases"][0]["extra"] = {"nested": {"value": 2}}
+        compiled_levels = set(main.COMPILED_RULES)
+
+        self.assertEqual(compare(original, new),
+                         (False, ["'sequences-canvases-extra-nested'.'value' failed comparison"]))
+        self.assertIs(main.get_level_rules("sequences-canvases-extra-nested"), main.EMPTY_LEVEL_RULES)
+        self.assertEqual(set(main.COMPILED_RULES), compiled_levels)
+
+    def test_levels_above_rules_compiled(self):
+        compiled = main.compile_rules({"a-b-c": {"ignore": ["@id"]}})
+        self.assertEqual(set(compiled), {"a", "a-b", "a-b-c"})
+        self.assertEqual(compiled["a-b-c"].ignore, {"@id"})
+        with mock.patch.object(main, "COMPILED_RULES", compiled):
+            self.assertIs(compiled["a"].next_level_rules("b").next_level_rules("c"), compiled["a-b-c"])
+            self.assertIs(compiled["a"].next_level_rules("d").next_level_rules("c"), main.EMPTY_LEVEL_RULES)
+
+
+if __name__ == '__main__':
+    unittest.main()
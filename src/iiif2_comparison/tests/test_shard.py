@@ -0,0 +1,76 @@
+"""
+Splitting b-numbers into shards and merging the shards' journals.
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from shard import merge_journals, select_shard  # noqa: E402
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
+
+
+def write_journal(path, *entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for bnumber, status in entries:
+            f.write(json.dumps({"bnumber": bnumber, "status": status}) + "\n")
+
+
+def read_journal(path):
+    with open(path, encoding="utf-8") as f:
+        return {entry["bnumber"]: entry["status"] for entry in map(json.loads, f)}
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_shards_cover_bnums_once(self):
+        bnums = [f"b{i:08}" for i in range(100)]
+        for by in ("hash", "range"):
+            with self.subTest(by=by):
+                shards = [list(select_shard(bnums, i, 3, by)) for i in range(3)]
+                self.assertEqual(sorted(bnum for shard in shards for bnum in shard), bnums)
+
+    def test_merge_into_existing_journal(self):
+        write_journal(self.path("results.jsonl"), ("b1", "passed"), ("b2", "errored"))
+        write_journal(self.path("results.0.jsonl"), ("b2", "failed"), ("b3", "passed"))
+        write_journal(self.path("results.1.jsonl"), ("b4", "errored"))
+
+        by_status = merge_journals([self.path("results.0.jsonl"), self.path("results.1.jsonl")],
+                                   self.path("results.jsonl"))
+
+        self.assertEqual(read_journal(self.path("results.jsonl")),
+                         {"b1": "passed", "b2": "failed", "b3": "passed", "b4": "errored"})
+        self.assertEqual(by_status, {"passed": ["b1", "b3"], "failed": ["b2"], "errored": ["b4"]})
+        self.assertFalse(os.path.exists(self.path("results.jsonl.partial")))
+
+    def test_merge_without_output(self):
+        write_journal(self.path("results.0.jsonl"), ("b1", "passed"))
+
+        self.assertEqual(merge_journals([self.path("results.0.jsonl")]),
+                         {"passed": ["b1"], "failed": [], "errored": []})
+        self.assertEqual(os.listdir(self.directory), ["results.0.jsonl"])
+
+    def test_shard_with_processes_rejected(self):
+        completed = subprocess.run([sys.executable, MAIN, "--shard", "0/2", "--processes", "2", "--journal",
+                                    self.path("results.jsonl")], capture_output=True, text=True)
+
+        self.assertEqual(completed.returncode, 2)
+        self.assertIn("--shard can't be used with --processes", completed.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Comparing manifests streamed with StreamedManifest gives the same verdict and failures, in the same order, as
+comparing them fully parsed.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import unittest
+
+import logzero
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from streaming import StreamedManifest  # noqa: E402
+from synthetic import alter_randomly, av_manifest, image_manifest  # noqa: E402
+
+logzero.loglevel(logging.WARNING)
+
+# randomly altered pairs compared each way
+PAIRS = 200
+
+
+class BytesStream:
+    """Async stream of body, read in small chunks so parsing is interleaved with comparing"""
+
+    def __init__(self, body, chunk_size=512):
+        self._body = body
+        self._chunk_size = chunk_size
+        self._offset = 0
+
+    async def read(self, n=-1):
+        size = self._chunk_size if n < 0 else min(n, self._chunk_size)
+        data = self._body[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+def compare(original, new):
+    try:
+        result = asyncio.run(main.Comparer(None).start_comparison(json.loads(original), json.loads(new)))
+        return result.passed, result.failures
+    except Exception as e:
+        return "error", type(e).__name__
+
+
+def compare_streamed(original, new):
+    try:
+        result = asyncio.run(main.Comparer(None).start_streamed_comparison(StreamedManifest(BytesStream(original)),
+                                                                           StreamedManifest(BytesStream(new))))
+        return result.passed, result.failures
+    except Exception as e:
+        return "error", type(e).__name__
+
+
+class StreamingTest(unittest.TestCase):
+    def assertSameResult(self, original, new):
+        original, new = json.dumps(original).encode(), json.dumps(new).encode()
+        self.assertEqual(compare_streamed(original, new), compare(original, new))
+
+    def test_altered_pairs(self):
+        rnd = random.Random(0)
+        for i in range(PAIRS):
+            make_manifest = rnd.choice([image_manifest, av_manifest])
+            authed = rnd.random() < 0.5
+            original = make_manifest("b10000001", 3, is_new=False, authed=authed)
+            new = make_manifest("b10000001", 3, is_new=True, authed=authed)
+            for _ in range(rnd.choice([0, 1, 2, 3])):
+                alter_randomly(rnd.choice([original, new]), rnd)
+
+            with self.subTest(pair=i, manifest=make_manifest.__name__, authed=authed):
+                self.assertSameResult(original, new)
+
+    def test_failures_around_canvases(self):
+        original = image_manifest("b10000001", 3, is_new=False)
+        new = image_manifest("b10000001", 3, is_new=True)
+        new["unexpected"] = "value"
+        new["sequences"][0]["label"] = "altered"
+        new["sequences"][0]["canvases"][1]["height"] += 1
+        new["sequences"][0]["viewingHint"] = "paged"
+        new["structures"] = []
+
+        self.assertSameResult(original, new)
+
+    def test_canvas_counts_differ(self):
+        for original_count, new_count in ((3, 2), (2, 3), (0, 1)):
+            with self.subTest(original=original_count, new=new_count):
+                original = image_manifest("b10000001", original_count, is_new=False)
+                new = image_manifest("b10000001", new_count, is_new=True)
+                # canvas before the difference in length fails, but isn't reported as it isn't compared
+                new["sequences"][0]["canvases"][:1] = [{"@id": "altered"}]
+
+                self.assertSameResult(original, new)
+                passed, failures = compare_streamed(json.dumps(original).encode(), json.dumps(new).encode())
+                self.assertIn("'sequences'.'canvases' lists of different length", failures)
+                self.assertFalse([failure for failure in failures if "sequences-canvases" in failure])
+
+    def test_canvases_not_reached(self):
+        original = image_manifest("b10000001", 2, is_new=False)
+        new = image_manifest("b10000001", 2, is_new=True)
+        new["sequences"][0]["canvases"][0]["height"] += 1
+        new["@type"] = "sc:Collection"
+
+        self.assertSameResult(original, new)
+
+
+if __name__ == '__main__':
+    unittest.main()
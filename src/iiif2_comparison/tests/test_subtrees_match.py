@@ -0,0 +1,95 @@
+"""
+Comparer.subtrees_match, the canonical form fast path of dictionary_comparison, must never change a result: comparing
+with it gives the same verdict and failures as always walking the whole tree.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import logging
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+import logzero
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from synthetic import alter_randomly, av_manifest, image_manifest  # noqa: E402
+
+logzero.loglevel(logging.WARNING)
+
+# randomly altered pairs compared each way
+PAIRS = 400
+
+
+class WalkingComparer(main.Comparer):
+    """Comparer without the fast path, always walks the whole tree"""
+
+    def subtrees_match(self, result, orig, new, level):
+        return False
+
+
+def compare(comparer_class, original, new):
+    try:
+        result = asyncio.run(comparer_class(None).start_comparison(original, new))
+        return result.passed, result.failures
+    except Exception as e:
+        return "error", type(e).__name__
+
+
+class SubtreesMatchTest(unittest.TestCase):
+    def assertSameResult(self, original, new):
+        self.assertEqual(compare(main.Comparer, original, new), compare(WalkingComparer, original, new))
+
+    def test_altered_pairs(self):
+        rnd = random.Random(0)
+        for i in range(PAIRS):
+            make_manifest = rnd.choice([image_manifest, av_manifest])
+            authed = rnd.random() < 0.5
+            original = make_manifest("b10000001", 3, is_new=False, authed=authed)
+            new = make_manifest("b10000001", 3, is_new=True, authed=authed)
+            for _ in range(rnd.choice([0, 1, 1, 2, 3])):
+                alter_randomly(rnd.choice([original, new]), rnd)
+
+            with self.subTest(pair=i, manifest=make_manifest.__name__, authed=authed):
+                self.assertSameResult(original, new)
+
+    def test_domain_insensitive_parts(self):
+        # no parts after the domain vs 1 empty part
+        original = av_manifest("b10000001", 1, is_new=False)
+        new = av_manifest("b10000001", 1, is_new=True)
+        original["mediaSequences"][0]["@id"] = "abc"
+        new["mediaSequences"][0]["@id"] = "https://host/"
+
+        self.assertSameResult(original, new)
+        self.assertFalse(compare(main.Comparer, original, new)[0])
+
+    def test_original_extra_key_missing_from_new(self):
+        # extra_orig allows an original key to be missing from new, but its value is still compared against ""
+        extra_orig_rules = {**main.rules, "sequences-canvases": {"ignore": ["@id"], "extra_orig": ["label"]}}
+        original = image_manifest("b10000001", 2, is_new=False)
+        new = image_manifest("b10000001", 2, is_new=True)
+        del new["sequences"][0]["canvases"][1]["label"]
+
+        with mock.patch.object(main, "COMPILED_RULES", main.compile_rules(extra_orig_rules)):
+            self.assertSameResult(original, new)
+            self.assertFalse(compare(main.Comparer, original, new)[0])
+
+    def test_clickthrough_profile(self):
+        original = image_manifest("b10000001", 1, is_new=False, authed=True)
+        new = image_manifest("b10000001", 1, is_new=True, authed=True)
+        self.assertSameResult(original, new)
+
+        # new profile that isn't a version of the clickthrough profile
+        original_services = original["sequences"][0]["canvases"][0]["images"][0]["resource"]["service"]
+        new_service = new["sequences"][0]["canvases"][0]["images"][0]["resource"]["service"]
+        self.assertIn(main.CLICKTHROUGH_PROFILES[0], str(original_services))
+        new_service["service"][0]["profile"] = "clickthrough"
+        self.assertSameResult(original, new)
+
+
+if __name__ == '__main__':
+    unittest.main()